@@ -0,0 +1,40 @@
+""" Pages/sec of the pdf extractors on a local corpus of filings.
+
+    cd app && python benchmarks/pdf_extractors.py <directory with pdf files> [--workers 4] [--repeat 3]
+"""
+import os, sys, glob, time, argparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from engine.loaders.file import pdf_extractor
+
+# LlamaParse is a remote API, not comparable
+BACKENDS = ['PyPDFLoader', 'PyMuPDF']
+
+
+def bench(extractor_type: str, files: list, num_workers: int, repeat: int) -> tuple:
+    best, pages = float('inf'), 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        content = pdf_extractor(extractor_type, files, num_workers=num_workers).extract_text()
+        best = min(best, time.perf_counter() - start)
+        pages = sum(len(p) for p in content.values())
+    return pages, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('corpus', help='directory with the pdf files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.corpus, '*.pdf')))
+    if not files:
+        sys.exit(f"No pdf file in {args.corpus}")
+    print(f"{len(files)} files, best of {args.repeat} runs\n")
+
+    print(f"{'backend':<14}{'workers':>8}{'pages':>8}{'seconds':>10}{'pages/sec':>12}")
+    for backend in BACKENDS:
+        for workers in sorted({1, args.workers}):
+            pages, seconds = bench(backend, files, workers, args.repeat)
+            print(f"{backend:<14}{workers:>8}{pages:>8}{seconds:>10.2f}{pages / seconds:>12.1f}")
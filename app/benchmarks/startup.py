@@ -0,0 +1,68 @@
+""" Cold start of the API: time to import main, to answer /health/live, and to be ready (/health/ready).
+    Also the import time of the heavy libraries, deferred until they are needed.
+
+    cd app && python benchmarks/startup.py [--port 8765] [--timeout 120] [--repeat 3]
+"""
+import os, sys, time, argparse, subprocess
+import urllib.request, urllib.error
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ['main', 'torch', 'sentence_transformers', 'weaviate', 'tiktoken', 'llama_index.legacy.text_splitter',
+           'langchain_community.document_loaders', 'litellm']
+
+
+def import_time(module: str) -> float:
+    """ Seconds to import a module in a fresh interpreter """
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, '-c', code], cwd=APP_DIR, capture_output=True, text=True)
+    if out.returncode:
+        return float('nan')
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def status(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return 0
+
+
+def server_start(port: int, timeout: float) -> tuple:
+    """ Seconds until the server is live, and until it is ready (nan if not within the timeout) """
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port)],
+                              cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    live = ready = float('nan')
+    try:
+        while time.perf_counter() - start < timeout:
+            if live != live and status(f"http://127.0.0.1:{port}/health/live") == 200:
+                live = time.perf_counter() - start
+            if live == live and status(f"http://127.0.0.1:{port}/health/ready") == 200:
+                ready = time.perf_counter() - start
+                break
+            time.sleep(0.05)
+    finally:
+        server.terminate()
+        server.wait()
+    return live, ready
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'module':<40}{'import (s)':>12}")
+    for module in MODULES:
+        print(f"{module:<40}{import_time(module):>12.2f}")
+
+    print(f"\n{'run':<6}{'live (s)':>10}{'ready (s)':>11}")
+    for run in range(1, args.repeat + 1):
+        live, ready = server_start(args.port, args.timeout)
+        print(f"{run:<6}{live:>10.2f}{ready:>11.2f}")
@@ -0,0 +1,271 @@
+import os, json, time, hashlib, threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+import numpy as np
+
+from settings import (embedding_cache_dir, embedding_cache_size, query_cache_size, query_cache_ttl,
+                      answer_cache_size, answer_cache_threshold, rerank_cache_size)
+from .logger import logger
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def normalize_query(query: str) -> str:
+    """ Case and whitespace don't change the meaning of a question """
+    return ' '.join(query.casefold().split())
+
+
+class LRUCache:
+    """ Thread-safe in-memory LRU cache. If ttl is set (seconds), entries expire after that time. """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (expiry, value), in LRU order
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None}
+
+
+# query vectors, keyed by (model, normalized query), shared by all the Weaviate clients
+query_vector_cache = LRUCache(max_entries=query_cache_size, ttl=query_cache_ttl)
+rerank_score_cache = LRUCache(max_entries=rerank_cache_size)  # (model, query, chunk hash) -> cross-encoder score
+
+
+class SemanticCache:
+    """ Answers to previous questions, reused for a new question if its vector is close enough
+        (cosine similarity >= threshold) to the one of a cached question, AND if the search returned
+        exactly the same context for both. 
+        invalidate() must be called whenever the content of the vector store changes.
+    """
+
+    def __init__(self, max_entries: int = 1024, threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._entries: OrderedDict = OrderedDict()  # id -> (context key, unit vector, answer), in LRU order
+        self._by_context: Dict[str, set] = {}  # context key -> ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _context_key(search_results: List[str], model: str) -> str:
+        return text_hash(model + '\x1e' + '\x1e'.join(search_results))
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, query_vector, search_results: List[str], model: str = '') -> Optional[str]:
+        context = self._context_key(search_results, model)
+        query = self._unit(query_vector)
+        with self._lock:
+            ids = list(self._by_context.get(context, ()))
+            if ids:
+                similarities = np.stack([self._entries[i][1] for i in ids]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self._entries.move_to_end(ids[best])
+                    self.hits += 1
+                    return self._entries[ids[best]][2]
+            self.misses += 1
+            return None
+
+    def store(self, query_vector, search_results: List[str], answer: str, model: str = ''):
+        context = self._context_key(search_results, model)
+        with self._lock:
+            entry_id, self._next_id = self._next_id, self._next_id + 1
+            self._entries[entry_id] = (context, self._unit(query_vector), answer)
+            self._by_context.setdefault(context, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                old_id, (old_context, _, _) = self._entries.popitem(last=False)
+                self._by_context[old_context].discard(old_id)
+                if not self._by_context[old_context]:
+                    del self._by_context[old_context]
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'threshold': self.threshold,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None}
+
+
+# answers of the RAG, invalidated by the engine every time the collection changes
+answer_cache = SemanticCache(max_entries=answer_cache_size, threshold=answer_cache_threshold)
+
+
+class EmbeddingCache:
+    """ On-disk cache of split embeddings for one model, keyed by the hash of the split text.
+        Vectors are stored in a memory-mapped float32 file of max_entries rows, and the index
+        (hash -> row, least recently used first) in a json file next to it.
+        When the cache is full, the least recently used row is overwritten.
+        The cache is meant to be written by one process at a time (the one doing the uploads).
+    """
+
+    def __init__(self, model_name: str, dim: int,
+                 cache_dir: str = embedding_cache_dir,
+                 max_entries: int = embedding_cache_size):
+        self.model_name = model_name
+        self.dim = dim
+        self.max_entries = max_entries
+        self.cache_dir = os.path.join(cache_dir, model_name.replace('/', '__'))
+        self.vectors_path = os.path.join(self.cache_dir, 'vectors.f32')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+
+        self.hits = self.misses = self.evictions = 0
+        self._dirty = False  # vectors added since the last flush
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._index: OrderedDict = OrderedDict()  # hash -> row, in LRU order
+
+        if os.path.exists(self.vectors_path) and os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                saved = json.load(f)
+            if saved['dim'] == self.dim and saved['max_entries'] == self.max_entries:
+                self._index = OrderedDict(saved['entries'])
+                self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+',
+                                          shape=(self.max_entries, self.dim))
+                return
+            logger.warning(f"Embedding cache {self.cache_dir} has a different layout, starting from scratch")
+
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='w+',
+                                  shape=(self.max_entries, self.dim))
+
+    def _check_files(self):
+        # the data directory can be erased through the API while we are running
+        if not os.path.exists(self.vectors_path):
+            self._load()
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns a (len(texts), dim) matrix with the cached vectors (zeros for misses)
+            and the boolean mask of the hits
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        hit = np.zeros(len(texts), dtype=bool)
+        with self._lock:
+            self._check_files()
+            for i, text in enumerate(texts):
+                key = text_hash(text)
+                row = self._index.get(key)
+                if row is not None:
+                    self._index.move_to_end(key)
+                    vectors[i] = self._vectors[row]
+                    hit[i] = True
+            self.hits += int(hit.sum())
+            self.misses += len(texts) - int(hit.sum())
+        return vectors, hit
+
+    def put(self, texts: List[str], vectors: np.ndarray):
+        with self._lock:
+            self._check_files()
+            for text, vector in zip(texts, vectors):
+                key = text_hash(text)
+                if key in self._index:
+                    self._index.move_to_end(key)
+                    continue
+                if len(self._index) >= self.max_entries:
+                    _, row = self._index.popitem(last=False)
+                    self.evictions += 1
+                else:
+                    row = len(self._index)
+                self._index[key] = row
+                self._vectors[row] = vector
+                self._dirty = True
+
+    def flush(self):
+        """ Writes the vectors and the index to disk, the index atomically (nothing to do if nothing was added) """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._vectors.flush()
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'dim': self.dim,
+                           'max_entries': self.max_entries,
+                           'entries': list(self._index.items())}, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'entries': len(self._index),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None}
+
+
+_embedding_caches: Dict[str, EmbeddingCache] = {}
+_embedding_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_name: str, dim: int) -> Optional[EmbeddingCache]:
+    """ The process-wide cache of a model, None if caching is disabled (embedding_cache_size = 0) """
+    if not embedding_cache_size:
+        return None
+    with _embedding_caches_lock:
+        if model_name not in _embedding_caches:
+            _embedding_caches[model_name] = EmbeddingCache(model_name, dim)
+        return _embedding_caches[model_name]
@@ -1,60 +1,205 @@
+import os, functools
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+import pandas as pd
 
+from settings import embedding_model, embedding_batch_size, ingest_batch_size
 
-import os
-import pandas as pd
-import torch
+# torch, tiktoken and llama_index take seconds to import: they are imported on first use,
+# so that importing this module (hence starting the API) stays fast
 
-from settings import parquet_file
+from engine.models import get_model
+from engine.cache import get_embedding_cache
+from engine.logger import logger
+from engine.staging import staging_store
+from engine.ledger import ledger, chunk_id
+from engine.metadata import parse_filename
 
-import tiktoken  # tokenizer library for use with OpenAI LLMs 
-from llama_index.legacy.text_splitter import SentenceSplitter
-from sentence_transformers import SentenceTransformer
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+@functools.lru_cache(maxsize=None)
+def get_device():
+    import torch
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# create tensors on GPU if available
-if torch.cuda.is_available():
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    # create tensors on GPU if available
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    return device
 
+# rough memory needed to encode one 256-token split with a base-size model (activations + attention)
+_BYTES_PER_SPLIT = 8 * 2**20
 
-def chunk_vectorize(doc_content: dict = None, 
-                    chunk_size: int = 256,    # limit for 'all-mpnet-base-v2'
-                    chunk_overlap: int = 20,  # some overlap to link the chunks
-                    encoder: str = 'gpt-3.5-turbo-0613',
-                    model_name: str = 'sentence-transformers/all-mpnet-base-v2'):  # can try all-MiniLM-L6-v2
-    # see tests in chunking_indexing.ipynb for more details
 
+def auto_batch_size() -> int:
+    """ Encoding batch size: the configured one, otherwise derived from the free memory of the device """
+    if embedding_batch_size:
+        return embedding_batch_size
+    
+    if get_device().type == 'cuda':
+        import torch
+        free, _ = torch.cuda.mem_get_info()
+        return int(min(max(free // 2 // _BYTES_PER_SPLIT, 16), 512))
+    
+    try:
+        free = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):  # not available on every OS
+        return 64
+    # on CPU, batches larger than ~128 don't go any faster, they only use more memory
+    return int(min(max(free // 4 // _BYTES_PER_SPLIT, 16), 128))
+
+
+def iter_splits(pages: Iterable[Tuple[str, int, str]],
+                chunk_size: int = 256,
+                chunk_overlap: int = 20,
+                encoder: str = 'gpt-3.5-turbo-0613') -> Iterator[Tuple[str, int, str]]:
+    """ Splits the pages as they come, yields (filename, page number, split) """
+    import tiktoken  # tokenizer library for use with OpenAI LLMs 
+    from llama_index.legacy.text_splitter import SentenceSplitter
+    
     encoding = tiktoken.encoding_for_model(encoder)
 
     splitter = SentenceSplitter(chunk_size=chunk_size, 
                                 tokenizer=encoding.encode, 
                                 chunk_overlap=chunk_overlap)
 
-    # let's create the splits for every document
-    contents_splits = {}
-    for fname, content in doc_content.items():
-        splits = [splitter.split_text(page) for page in content]
-        contents_splits[fname] = [split for sublist in splits for split in sublist]
-        
-    model = SentenceTransformer(model_name)
+    for fname, page_no, text in pages:
+        for split in splitter.split_text(text):
+            yield fname, page_no, split
+
 
-    content_emb = {}
-    for fname, splits in contents_splits.items():
-        content_emb[fname] = [(split, model.encode(split)) for split in splits]
+def iter_batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    # save fname since it carries information, and could be used as a property in Weaviate
-    text_vector_tuples = [(fname, split, emb.tolist()) for fname, splits_emb in content_emb.items() for split, emb in splits_emb]
 
-    new_df = pd.DataFrame(
-        text_vector_tuples, 
-        columns=['file', 'content', 'content_embedding']
-    )
+def embed_splits(splits: List[str], 
+                 model_name: str = embedding_model,
+                 batch_size: int = None,
+                 flush: bool = True) -> np.ndarray:
+    """ Encodes all the splits in large batches, returns a (len(splits), dim) float32 matrix.
+        Splits already seen (re-uploads, restated filings) come from the on-disk cache.
+        flush=False leaves the new vectors in memory until flush_embedding_cache() (once per upload, not per batch)
+    """
     
-    # load the existing parquet file if it exists and update it 
-    if os.path.exists(parquet_file):
-        new_df = pd.concat([pd.read_parquet(parquet_file), new_df])
+    get_device()  # torch creates its tensors on the GPU if there is one
+    model = get_model(model_name)  # shared with the query path, loaded once per process
+    dim = model.get_sentence_embedding_dimension()
+    if not splits:
+        return np.empty((0, dim), dtype=np.float32)
+
+    cache = get_embedding_cache(model_name, dim)
+    if cache is None:
+        embeddings, hit = np.empty((len(splits), dim), dtype=np.float32), np.zeros(len(splits), dtype=bool)
+    else:
+        embeddings, hit = cache.lookup(splits)
+    
+    missing = np.flatnonzero(~hit)
+    if len(missing):
+        to_encode = [splits[i] for i in missing]
+        embeddings[missing] = model.encode(to_encode, 
+                                           batch_size=batch_size or auto_batch_size(),
+                                           convert_to_numpy=True,
+                                           show_progress_bar=False)
+        if cache is not None:
+            cache.put(to_encode, embeddings[missing])
+            if flush:
+                cache.flush()
+    
+    if cache is not None:
+        logger.info(f"Embedded {len(splits)} splits, {len(splits) - len(missing)} from cache ({cache.stats()})")
+    return embeddings
+
+
+def flush_embedding_cache(model_name: str = embedding_model):
+    """ Writes the vectors added to the embedding cache of the model, and its index, to disk """
+    cache = get_embedding_cache(model_name, get_model(model_name).get_sentence_embedding_dimension())
+    if cache is not None:
+        cache.flush()
+
+
+def vectorize_pages(pages: Iterable[Tuple[str, int, str]],
+                    chunk_size: int = 256,    # limit for 'all-mpnet-base-v2'
+                    chunk_overlap: int = 20,  # some overlap to link the chunks
+                    encoder: str = 'gpt-3.5-turbo-0613',
+                    model_name: str = embedding_model,  # can try all-MiniLM-L6-v2
+                    batch_size: int = None,
+                    file_hashes: Dict[str, str] = None,
+                    file_metadata: Dict[str, dict] = None,
+                    progress: Callable = None) -> Dict[str, dict]:
+    """ Streaming pipeline: pages -> splits -> batched embeddings -> appended to a new staging part.
+        pages is an iterator of (filename, page number, text), e.g. PDFExtractor.iter_pages().
+        Only one batch of 'ingest_batch_size' splits is in memory at any time, whatever the size of the documents.
+        progress, if given, is called with the counters pages_parsed and chunks_embedded as they increase.
+        file_hashes (filename -> content hash) are used for the chunk ids, and the chunks are recorded in the ledger.
+        Every chunk is stored with its filename, page (from 1), chunk_index (in the file), and the ticker and
+        fiscal_period of file_metadata (filename -> dict, see engine/metadata.py), '' if unknown.
+        Returns the number of pages and chunks of every file.
+    """
+    summary = {}
+
+    def count_pages(pages):
+        for fname, page_no, text in pages:
+            summary.setdefault(fname, {'pages': 0, 'chunks': 0})['pages'] += 1
+            if progress:
+                progress(pages_parsed=1)
+            yield fname, page_no, text
+
+    file_hashes = file_hashes or {}
+    file_metadata = file_metadata or {}
+    staged = []  # (chunk id, file hash), recorded in the ledger once the part is committed
+    splits = iter_splits(count_pages(pages), chunk_size, chunk_overlap, encoder)
+    # one immutable part per call, visible to the indexer only once complete
+    # the embedding cache is written once at the end (its index is rewritten whole, so not after every batch)
+    try:
+        with staging_store.writer() as part:
+            for batch in iter_batches(splits, ingest_batch_size):
+                fnames, page_nos, contents = zip(*batch)
+                embeddings = embed_splits(list(contents), model_name, batch_size, flush=False)
+                hashes = [file_hashes.get(fname, fname) for fname in fnames]
+                chunk_ids = [chunk_id(fhash, content) for fhash, content in zip(hashes, contents)]
+                chunk_indexes = []
+                for fname in fnames:
+                    chunk_indexes.append(summary[fname]['chunks'])
+                    summary[fname]['chunks'] += 1
+                metadata = [file_metadata.get(fname, {}) for fname in fnames]
+            
+                # the metadata columns become properties in Weaviate, so the searches can be filtered on them
+                # the embeddings are stored as a float32 matrix, next to the other columns
+                part.append(pd.DataFrame({'filename': fnames, 
+                                          'page': [page_no + 1 for page_no in page_nos],
+                                          'chunk_index': chunk_indexes,
+                                          'ticker': [meta.get('ticker') or '' for meta in metadata],
+                                          'fiscal_period': [meta.get('fiscal_period') or '' for meta in metadata],
+                                          'content': contents, 
+                                          'chunk_id': chunk_ids}), embeddings)
+                staged.extend(zip(chunk_ids, hashes))
+                if progress:
+                    progress(chunks_embedded=len(batch))
+    finally:
+        flush_embedding_cache(model_name)  # also the vectors of a failed upload, they will be reused
+    
+    ledger.stage_chunks(part.name, staged)
+    # a crash right before this line leaves chunks the ledger doesn't know: they are indexed anyway (see index_data)
+    return summary
+
+
+def chunk_vectorize(doc_content: dict = None, 
+                    chunk_size: int = 256,    # limit for 'all-mpnet-base-v2'
+                    chunk_overlap: int = 20,  # some overlap to link the chunks
+                    encoder: str = 'gpt-3.5-turbo-0613',
+                    model_name: str = embedding_model,  # can try all-MiniLM-L6-v2
+                    batch_size: int = None):
+    # see tests in chunking_indexing.ipynb for more details
+    # same as vectorize_pages, for documents already extracted: {filename: [text of each page]}
 
-    # no optimization here (zipping etc) since the data is small
-    new_df.to_parquet(parquet_file, index=False)        
+    pages = ((fname, page_no, text) for fname, content in doc_content.items() for page_no, text in enumerate(content))
+    vectorize_pages(pages, chunk_size, chunk_overlap, encoder, model_name, batch_size,
+                    file_metadata={fname: parse_filename(fname) for fname in doc_content})
     
     return
@@ -0,0 +1,128 @@
+import time, queue, threading
+from contextlib import contextmanager
+from typing import Callable
+
+from weaviate import WeaviateClient
+
+from settings import weaviate_pool_size, weaviate_health_check_interval, weaviate_pool_timeout
+from .logger import logger
+
+
+class WeaviateConnectionPool:
+    """ Bounded pool of long-lived Weaviate clients, shared by the concurrent requests.
+        Clients are created lazily (up to 'size'), health-checked when they have been idle for
+        more than 'health_check_interval' seconds, and reconnected if the check fails.
+        Callers wait up to 'timeout' seconds for a free client when they are all in use.
+    """
+
+    def __init__(self,
+                 connect: Callable[[], WeaviateClient],
+                 size: int = weaviate_pool_size,
+                 health_check_interval: float = weaviate_health_check_interval,
+                 timeout: float = weaviate_pool_timeout):
+        self._connect = connect
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        self._idle = queue.LifoQueue()  # (client, time of the last health check), most recent first
+        self._clients = []
+        self._lock = threading.Lock()
+        self._stats = {'created': 0, 'acquired': 0, 'reused': 0, 'waited': 0,
+                       'health_checks': 0, 'reconnects': 0}
+
+    @contextmanager
+    def connection(self):
+        """ with pool.connection() as client: ... """
+        client, checked_at = self._acquire()
+        try:
+            yield client
+        except Exception:
+            checked_at = float('-inf')  # the connection may be broken, check it before reusing it
+            raise
+        finally:
+            self._idle.put((client, checked_at))
+
+    def _acquire(self):
+        with self._lock:
+            self._stats['acquired'] += 1
+        try:
+            client, checked_at = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = len(self._clients) < self.size
+                if can_create:
+                    self._clients.append(None)  # reserve the slot while connecting
+            if can_create:
+                return self._create(), time.monotonic()
+            with self._lock:
+                self._stats['waited'] += 1
+            try:
+                client, checked_at = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No Weaviate connection available after {self.timeout}s")
+
+        with self._lock:
+            self._stats['reused'] += 1
+        if time.monotonic() - checked_at > self.health_check_interval:
+            client = self._check(client)
+            checked_at = time.monotonic()
+        return client, checked_at
+
+    def _create(self) -> WeaviateClient:
+        try:
+            client = self._connect()
+        except Exception:
+            with self._lock:
+                self._clients.remove(None)
+            raise
+        with self._lock:
+            self._clients[self._clients.index(None)] = client
+            self._stats['created'] += 1
+        return client
+
+    @staticmethod
+    def _healthy(client: WeaviateClient) -> bool:
+        try:
+            return client.is_connected() and client.is_live()
+        except Exception:
+            return False
+
+    def _check(self, client: WeaviateClient) -> WeaviateClient:
+        """ Returns the client if it's healthy, otherwise a reconnected (or new) one """
+        with self._lock:
+            self._stats['health_checks'] += 1
+        if self._healthy(client):
+            return client
+
+        logger.warning("Weaviate connection is not healthy, reconnecting")
+        with self._lock:
+            self._stats['reconnects'] += 1
+        try:
+            client.close()
+            client.connect()
+            return client
+        except Exception as e:
+            logger.warning(f"Could not reconnect ({e}), opening a new connection")
+            with self._lock:
+                self._clients[self._clients.index(client)] = None
+            return self._create()
+
+    def close(self):
+        """ Closes all the connections, on shutdown """
+        with self._lock:
+            clients = [c for c in self._clients if c is not None]
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                logger.warning(f"Error while closing a Weaviate connection: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open'] = len([c for c in self._clients if c is not None])
+        stats['size'] = self.size
+        stats['idle'] = self._idle.qsize()
+        stats['reuse_rate'] = round(stats['reused'] / stats['acquired'], 3) if stats['acquired'] else None
+        return stats
@@ -0,0 +1,57 @@
+from typing import Dict, List, Tuple
+
+from .cache import text_hash
+
+# Client-side fusion of the keyword (BM25) and vector results, instead of Weaviate's hybrid query:
+# both searches run concurrently, and the fusion can be tuned without touching the index.
+# A leg is a list of (result, score) pairs, best first. The results are the dicts of WeaviateWCS.format_response.
+
+
+def result_id(result: dict) -> str:
+    # the objects indexed before the chunk ids existed are identified by their content
+    return result.get('chunk_id') or text_hash(result.get('content') or '')
+
+
+def reciprocal_rank_fusion(legs: Dict[str, List[Tuple[dict, float]]],
+                           weights: Dict[str, float],
+                           k: int = 60) -> List[Tuple[dict, float]]:
+    """ score = sum over the legs of weight / (k + rank): only the ranks matter, not the scales of the scores """
+    fused, results = {}, {}
+    for name, leg in legs.items():
+        for rank, (result, _) in enumerate(leg, 1):
+            rid = result_id(result)
+            results.setdefault(rid, result)
+            fused[rid] = fused.get(rid, 0.0) + weights.get(name, 1.0) / (k + rank)
+    return sorted(((results[rid], score) for rid, score in fused.items()), key=lambda item: -item[1])
+
+
+def relative_score_fusion(legs: Dict[str, List[Tuple[dict, float]]],
+                          weights: Dict[str, float]) -> List[Tuple[dict, float]]:
+    """ The scores of each leg are scaled to [0, 1] (min-max), then summed with the weights (like Weaviate's) """
+    fused, results = {}, {}
+    for name, leg in legs.items():
+        if not leg:
+            continue
+        scores = [score for _, score in leg]
+        low, high = min(scores), max(scores)
+        for result, score in leg:
+            rid = result_id(result)
+            results.setdefault(rid, result)
+            norm = (score - low) / (high - low) if high > low else 1.0
+            fused[rid] = fused.get(rid, 0.0) + weights.get(name, 1.0) * norm
+    return sorted(((results[rid], score) for rid, score in fused.items()), key=lambda item: -item[1])
+
+
+def fuse(legs: Dict[str, List[Tuple[dict, float]]],
+         method: str = 'rrf',
+         alpha: float = 0.5,
+         k: int = 60) -> List[Tuple[dict, float]]:
+    """ Fuses the 'keyword' and 'vector' legs, alpha is the weight of the vector leg (as in hybrid_search).
+        The results found by both legs appear once (same chunk id).
+    """
+    weights = {'keyword': 1 - alpha, 'vector': alpha}
+    if method == 'rrf':
+        return reciprocal_rank_fusion(legs, weights, k)
+    if method == 'relative':
+        return relative_score_fusion(legs, weights)
+    raise ValueError(f"Unknown fusion method: {method}, use 'rrf' or 'relative'")
@@ -0,0 +1,145 @@
+import os, json, time, uuid, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Dict, List, Optional
+
+from settings import jobs_file, ingest_workers, job_concurrency, max_finished_jobs
+from .logger import logger
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str  # name of the handler, e.g. 'upload' or 'index'
+    args: dict
+    status: str = 'queued'  # queued -> running -> done | failed
+    progress: dict = field(default_factory=dict)  # counters reported by the handler, e.g. pages_parsed
+    result: Any = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+class JobManager:
+    """ Runs long tasks (extraction + embedding, indexing) in a bounded pool of threads, so that the
+        requests return immediately with a job id.
+        - handlers: kind -> function called as handler(**job.args, progress=callback), the callback takes
+          keyword counters (e.g. progress(pages_parsed=12)) that are added to job.progress
+        - concurrency: kind -> max number of jobs of that kind running at the same time. The jobs over the limit
+          wait in a queue of their kind, not in the pool: they don't hold a worker the other kinds could use
+        Jobs are saved in a json file: after a restart, resume() runs again the jobs that were queued or running.
+        It's called by the startup of the API, not here: importing main (reloader, pdf workers) must not run them.
+    """
+
+    def __init__(self,
+                 handlers: Dict[str, Callable],
+                 jobs_file: str = jobs_file,
+                 max_workers: int = ingest_workers,
+                 concurrency: Dict[str, int] = job_concurrency,
+                 max_finished: int = max_finished_jobs):
+        self.handlers = handlers
+        self.jobs_file = jobs_file
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='finrag-job')
+        self._limits = dict(concurrency)
+        self._running: Dict[str, int] = {}  # kind -> jobs submitted to the pool
+        self._pending: Dict[str, deque] = {}  # kind -> jobs waiting for one of them to finish
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.RLock()
+        self._saved_at = 0.0
+
+    def submit(self, kind: str, **args) -> Job:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = Job(id=uuid.uuid4().hex, kind=kind, args=args)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._save()
+            self._dispatch(job)
+        logger.info(f"Job {job.id} ({kind}) queued")
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return asdict(job) if job else None
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            return [asdict(job) for job in self._jobs.values()]
+
+    def _dispatch(self, job: Job):
+        # called under self._lock
+        limit = self._limits.get(job.kind)
+        if limit and self._running.get(job.kind, 0) >= limit:
+            self._pending.setdefault(job.kind, deque()).append(job)
+            return
+        self._running[job.kind] = self._running.get(job.kind, 0) + 1
+        self._executor.submit(self._run, job)
+
+    def _run(self, job: Job):
+        try:
+            with self._lock:
+                job.status, job.started_at = 'running', time.time()
+                self._save()
+            result = self.handlers[job.kind](**job.args, progress=lambda **counts: self._progress(job, counts))
+            with self._lock:
+                job.result, job.status = result, 'done'
+            logger.info(f"Job {job.id} ({job.kind}) done")
+        except Exception as e:
+            with self._lock:
+                job.status, job.error = 'failed', str(e)
+            logger.error(f"Job {job.id} ({job.kind}) failed: {str(e)}")
+        finally:
+            with self._lock:
+                job.finished_at = time.time()
+                self._running[job.kind] -= 1
+                pending = self._pending.get(job.kind)
+                if pending:
+                    self._dispatch(pending.popleft())
+                self._prune()
+                self._save()
+
+    def _progress(self, job: Job, counts: dict):
+        with self._lock:
+            for key, value in counts.items():
+                job.progress[key] = job.progress.get(key, 0) + value
+            if time.monotonic() - self._saved_at > 1.0:  # no need to rewrite the file for every batch
+                self._save()
+
+    def _prune(self):
+        finished = [job for job in self._jobs.values() if job.status in ('done', 'failed')]
+        for job in sorted(finished, key=lambda j: j.finished_at or 0)[:-self.max_finished or None]:
+            del self._jobs[job.id]
+
+    def _save(self):
+        # the data directory can be erased through the API, so it may have to be recreated
+        os.makedirs(os.path.dirname(self.jobs_file), exist_ok=True)
+        tmp_path = self.jobs_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([asdict(job) for job in self._jobs.values()], f, default=str)
+        os.replace(tmp_path, self.jobs_file)
+        self._saved_at = time.monotonic()
+
+    def resume(self):
+        """ Loads the jobs saved by the previous run, and runs again the ones that were interrupted """
+        if not os.path.exists(self.jobs_file):
+            return
+        try:
+            with open(self.jobs_file) as f:
+                jobs = [Job(**job) for job in json.load(f)]
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Could not read {self.jobs_file} ({e}), previous jobs are lost")
+            return
+
+        with self._lock:
+            for job in jobs:
+                if job.id in self._jobs:  # already resumed, or submitted since the start
+                    continue
+                self._jobs[job.id] = job
+                if job.status in ('queued', 'running') and job.kind in self.handlers:
+                    logger.warning(f"Job {job.id} ({job.kind}) was interrupted, running it again")
+                    job.status, job.progress, job.started_at = 'queued', {}, None
+                    self._dispatch(job)
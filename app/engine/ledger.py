@@ -0,0 +1,109 @@
+import os, time, uuid, sqlite3, hashlib, threading
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Set, Tuple
+
+from settings import ledger_file
+from .cache import text_hash
+
+# chunk ids are uuid5 of (file content hash, chunk text hash): the same chunk always gets the same id,
+# so indexing it again overwrites the object in Weaviate instead of duplicating it
+_CHUNK_NAMESPACE = uuid.UUID('6f1f1a3e-4c9b-5b7e-9d7e-2f6a0c3b8e41')
+
+
+def chunk_id(file_key: str, content: str) -> str:
+    return str(uuid.uuid5(_CHUNK_NAMESPACE, f"{file_key}/{text_hash(content)}"))
+
+
+def file_hash(filepath: str, block_size: int = 2**20) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IndexLedger:
+    """ Records the state of every uploaded file and staged chunk: 'staged', 'indexed' or 'failed'.
+        It's what lets index_data push only the delta, resume after a crash (chunks pushed again
+        keep their id, so they are overwritten, not duplicated), and skip files uploaded twice.
+    """
+
+    def __init__(self, db_path: str = ledger_file):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _db(self):
+        # one connection per operation: sqlite is cheap to open, and the data directory can be erased at any time
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._lock:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS files (file_hash TEXT PRIMARY KEY, filename TEXT, state TEXT,
+                                                      updated_at REAL);
+                    CREATE TABLE IF NOT EXISTS chunks (chunk_id TEXT PRIMARY KEY, file_hash TEXT, part TEXT,
+                                                       state TEXT, error TEXT, updated_at REAL);
+                    CREATE INDEX IF NOT EXISTS chunks_part ON chunks (part);
+                """)
+                with conn:  # commits, or rolls back on error
+                    yield conn
+            finally:
+                conn.close()
+
+    def file_state(self, file_hash: str) -> Optional[str]:
+        with self._db() as conn:
+            row = conn.execute("SELECT state FROM files WHERE file_hash = ?", (file_hash,)).fetchone()
+        return row[0] if row else None
+
+    def stage_file(self, file_hash: str, filename: str):
+        with self._db() as conn:
+            conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, 'staged', ?)", (file_hash, filename, time.time()))
+
+    def stage_chunks(self, part: str, chunks: Iterable[Tuple[str, str]]):
+        """ chunks: (chunk id, file hash) of the chunks written in a staging part """
+        now = time.time()
+        with self._db() as conn:
+            conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, 'staged', NULL, ?)",
+                             [(cid, fhash, part, now) for cid, fhash in chunks])
+
+    def indexed_chunks(self, parts: List[str]) -> Set[str]:
+        """ Ids of the chunks of these staging parts that are already indexed """
+        with self._db() as conn:
+            rows = conn.execute(f"SELECT chunk_id FROM chunks WHERE state = 'indexed' "
+                                f"AND part IN ({','.join('?' * len(parts))})", parts).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_chunks(self, chunks: Iterable[Tuple[str, str]], state: str, error: str = None):
+        """ chunks: (chunk id, staging part). Chunks unknown to the ledger are added. """
+        now = time.time()
+        with self._db() as conn:
+            conn.executemany("""INSERT INTO chunks VALUES (?, NULL, ?, ?, ?, ?)
+                                ON CONFLICT(chunk_id) DO UPDATE SET state = excluded.state,
+                                error = excluded.error, updated_at = excluded.updated_at""",
+                             [(cid, part, state, error, now) for cid, part in chunks])
+
+    def update_files(self):
+        """ A file is 'indexed' when all its chunks are, 'failed' if one of them failed """
+        with self._db() as conn:
+            conn.execute("""UPDATE files SET updated_at = ?, state = CASE
+                                WHEN EXISTS (SELECT 1 FROM chunks c WHERE c.file_hash = files.file_hash
+                                             AND c.state = 'failed') THEN 'failed'
+                                WHEN NOT EXISTS (SELECT 1 FROM chunks c WHERE c.file_hash = files.file_hash
+                                                 AND c.state != 'indexed') THEN 'indexed'
+                                ELSE state END""", (time.time(),))
+
+    def forget_indexed(self):
+        """ After the collection is emptied, nothing is indexed anymore (staged chunks are still staged) """
+        with self._db() as conn:
+            conn.execute("DELETE FROM chunks WHERE state != 'staged'")
+            conn.execute("DELETE FROM files WHERE state != 'staged'")
+
+    def stats(self) -> dict:
+        with self._db() as conn:
+            files = dict(conn.execute("SELECT state, COUNT(*) FROM files GROUP BY state").fetchall())
+            chunks = dict(conn.execute("SELECT state, COUNT(*) FROM chunks GROUP BY state").fetchall())
+        return {'files': files, 'chunks': chunks}
+
+
+ledger = IndexLedger()
@@ -1,11 +1,15 @@
 import os
+from collections import deque
 
-# from langchain.document_loaders import PyPDFLoader  # deprecated
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from llama_parse import LlamaParse  
+# langchain and llama_parse are imported by the extractors that use them: they are slow to import,
+# and most processes (the API server, the pdf workers) never need them
+import fitz  # PyMuPDF
+import pypdf
 
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Iterator, Tuple
+
+from settings import pdf_pages_per_task
+from .pdf_workers import page_count, extract_pages, get_pool
 
 from abc import ABC, abstractmethod
 
@@ -39,16 +43,79 @@ class PDFExtractor(ABC):
             Return in json format
         """
         pass
+    
+    def _extract_text_parallel(self, backend: str, pages_per_task: int = pdf_pages_per_task):
+        """ Same output as extract_text, but the files are cut in page ranges parsed by a pool of processes,
+            so that a single large file is also spread over several cores
+        """
+        pool = get_pool(self.num_workers)
+        
+        tasks = {}  # fname -> futures of its page ranges, in page order
+        for fpath in self.filelist:
+            fname = fpath.split('/')[-1]
+            num_pages = page_count(fpath, backend)
+            tasks[fname] = [pool.submit(extract_pages, fpath, start, min(start + pages_per_task, num_pages), backend)
+                            for start in range(0, num_pages, pages_per_task)]
+        
+        return {fname: [page for future in futures for page in future.result()] 
+                for fname, futures in tasks.items()}
+    
+    def iter_pages(self) -> Iterator[Tuple[str, int, str]]:
+        """ Yields (filename, page number from 0, text) one page at a time, in order.
+            By default it goes through extract_text, backends able to stream override it.
+        """
+        for fname, pages in self.extract_text().items():
+            for page_no, text in enumerate(pages):
+                yield fname, page_no, text
+    
+    def _iter_pages_parallel(self, backend: str, pages_per_task: int = pdf_pages_per_task):
+        """ Same as iter_pages, with the page ranges parsed by the process pool.
+            At most 2 * num_workers ranges are in flight, so the memory stays bounded whatever the size of the files
+        """
+        pool = get_pool(self.num_workers)
+        in_flight = deque()  # (fname, first page, future), in page order
+        
+        def pop():
+            fname, start, future = in_flight.popleft()
+            for i, text in enumerate(future.result()):
+                yield fname, start + i, text
+        
+        for fpath in self.filelist:
+            fname = fpath.split('/')[-1]
+            num_pages = page_count(fpath, backend)
+            for start in range(0, num_pages, pages_per_task):
+                future = pool.submit(extract_pages, fpath, start, min(start + pages_per_task, num_pages), backend)
+                in_flight.append((fname, start, future))
+                if len(in_flight) >= 2 * self.num_workers:
+                    yield from pop()
+        while in_flight:
+            yield from pop()
 
 class _PyPDFLoader(PDFExtractor):
     
     def extract_text(self):
+        if self.num_workers > 1:
+            return self._extract_text_parallel('pypdf')
+        
+        # from langchain.document_loaders import PyPDFLoader  # deprecated
+        from langchain_community.document_loaders import PyPDFLoader
         output_dict = {}
         for fpath in self.filelist:
             fname = fpath.split('/')[-1]
             output_dict[fname] = [p.page_content for p in PyPDFLoader(fpath).load()]  
         return output_dict
     
+    def iter_pages(self):
+        if self.num_workers > 1:
+            yield from self._iter_pages_parallel('pypdf')
+            return
+        
+        for fpath in self.filelist:
+            fname = fpath.split('/')[-1]
+            # PyPDFLoader.load parses all the pages first, pypdf's reader parses them on demand
+            for page_no, page in enumerate(pypdf.PdfReader(fpath).pages):
+                yield fname, page_no, page.extract_text()
+    
     def extract_images(self):
         raise NotImplementedError("Not implemented or PyPDFLoader does not support image extraction")
         return 
@@ -58,6 +125,57 @@ class _PyPDFLoader(PDFExtractor):
         return
 
 
+class _PyMuPDF(PDFExtractor):
+    """ PyMuPDF (C library) is several times faster than pypdf, and can find the tables """
+    
+    def extract_text(self):
+        if self.num_workers > 1:
+            return self._extract_text_parallel('pymupdf')
+        
+        output_dict = {}
+        for fpath in self.filelist:
+            fname = fpath.split('/')[-1]
+            with fitz.open(fpath) as doc:
+                output_dict[fname] = [page.get_text() for page in doc]
+        return output_dict
+    
+    def iter_pages(self):
+        if self.num_workers > 1:
+            yield from self._iter_pages_parallel('pymupdf')
+            return
+        
+        for fpath in self.filelist:
+            fname = fpath.split('/')[-1]
+            with fitz.open(fpath) as doc:
+                for page in doc:
+                    yield fname, page.number, page.get_text()
+    
+    def extract_images(self):
+        raise NotImplementedError("Not implemented for PyMuPDF yet")
+        return 
+    
+    def extract_tables(self) -> Dict[str, List[dict]]:
+        """ Return a dictionary, key = filename, value = list of the tables found in the file,
+            each table being {'page': page number (from 0), 'header': column names, 'rows': list of rows}
+            Cells are strings, or None when empty/merged.
+        """
+        output_dict = {}
+        for fpath in self.filelist:
+            fname = fpath.split('/')[-1]
+            tables = []
+            with fitz.open(fpath) as doc:
+                for page in doc:
+                    for table in page.find_tables().tables:
+                        rows = table.extract()
+                        if not table.header.external:  # the header is the first row of the table, not data
+                            rows = rows[1:]
+                        tables.append({'page': page.number,
+                                       'header': table.header.names,
+                                       'rows': rows})
+            output_dict[fname] = tables
+        return output_dict
+
+
 class _LlamaParse(PDFExtractor):
     
     def extract_text(self):
@@ -65,6 +183,7 @@ class _LlamaParse(PDFExtractor):
         if os.getenv("LLAMA_PARSE_API_KEY") is None:
             raise ValueError("LLAMA_PARSE_API_KEY is not set.")
         
+        from llama_parse import LlamaParse
         parser = LlamaParse(
             api_key = os.getenv("LLAMA_PARSE_API_KEY"),
             num_workers=self.num_workers,
@@ -95,6 +214,9 @@ def pdf_extractor(extractor_type: str, *args, **kwargs) -> PDFExtractor:
     if extractor_type == 'PyPDFLoader':
         return _PyPDFLoader(*args, **kwargs)
     
+    elif extractor_type == 'PyMuPDF':
+        return _PyMuPDF(*args, **kwargs)
+    
     elif extractor_type == 'LlamaParse':
         return _LlamaParse(*args, **kwargs)
     else:
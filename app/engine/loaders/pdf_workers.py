@@ -0,0 +1,47 @@
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import pypdf
+
+# Kept out of file.py on purpose: the worker processes only import this module (and the pdf library),
+# not langchain, llama_parse or torch, so they start fast.
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def page_count(fpath: str, backend: str = 'pypdf') -> int:
+    if backend == 'pymupdf':
+        import fitz
+        with fitz.open(fpath) as doc:
+            return doc.page_count
+    return len(pypdf.PdfReader(fpath).pages)
+
+
+def extract_pages(fpath: str, start: int, stop: int, backend: str = 'pypdf') -> List[str]:
+    """ Text of the pages [start, stop) of a pdf.
+        With pypdf, same output as PyPDFLoader's page_content.
+    """
+    if backend == 'pymupdf':
+        import fitz
+        with fitz.open(fpath) as doc:
+            return [doc[i].get_text() for i in range(start, stop)]
+    reader = pypdf.PdfReader(fpath)
+    return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+def get_pool(num_workers: int) -> ProcessPoolExecutor:
+    """ Process pool shared by the extractions, created on first use (and resized if needed).
+        Workers are spawned, not forked, since the parent process may hold torch/CUDA state and threads.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != num_workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context('spawn'))
+            _pool_workers = num_workers
+        return _pool
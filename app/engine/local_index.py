@@ -0,0 +1,482 @@
+import os, re, json, math, time, uuid, shutil, threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    import hnswlib  # optional: approximate search for the large collections
+except ImportError:
+    hnswlib = None
+
+from settings import local_index_dir, local_ann_threshold, local_hybrid_candidates
+from .logger import logger
+from .weaviate_interface_v4 import WeaviateWCS, IndexingResult
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def _to_json(value):
+    # numpy scalars (e.g. page numbers read from parquet) are stored as plain numbers
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+class BM25Index:
+    """ Inverted index of one text property, scored with BM25 (same k1 and b as Weaviate).
+        Rows are only appended: the deleted (or replaced) rows are masked when scoring.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1, self.b = k1, b
+        self.postings: Dict[str, tuple] = {}  # term -> (rows, term frequencies)
+        self.lengths: List[int] = []  # number of tokens of every row
+        self._lengths = None  # numpy copy of lengths, rebuilt after additions
+
+    def add(self, text: str):
+        tokens = tokenize(text or '')
+        row = len(self.lengths)
+        self.lengths.append(len(tokens))
+        for term, count in Counter(tokens).items():
+            rows, freqs = self.postings.setdefault(term, ([], []))
+            rows.append(row)
+            freqs.append(count)
+        self._lengths = None
+
+    def scores(self, query: str, alive: np.ndarray) -> np.ndarray:
+        """ BM25 score of every row for the query (0 for the rows without any of its terms) """
+        if self._lengths is None:
+            self._lengths = np.asarray(self.lengths, dtype=np.float32)
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        num_alive = int(alive.sum())
+        if num_alive == 0:
+            return scores
+        avgdl = max(float(self._lengths[alive].mean()), 1.0)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            rows, freqs = (np.asarray(x) for x in self.postings[term])
+            live = alive[rows]
+            rows, freqs = rows[live], freqs[live]
+            if len(rows) == 0:
+                continue
+            idf = math.log(1 + (num_alive - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[rows] / avgdl)
+            scores[rows] += idf * freqs * (self.k1 + 1) / (freqs + norm)
+        return scores
+
+
+class LocalCollection:
+    """ A collection stored on disk, searched in process.
+        - vectors.f32: normalized float32 vectors, one row per object, read with a memory map
+        - objects.jsonl: uuid and properties of every row
+        Both files are only appended to: an object indexed again (same uuid) gets a new row and the old one
+        is masked, until the collection is compacted. The BM25 indexes are rebuilt from the properties on load.
+        Above 'ann_threshold' vectors, the vector searches go through an HNSW index (if hnswlib is installed),
+        saved in hnsw.bin.
+    """
+
+    def __init__(self, path: str, searchable: List[str] = None, ann_threshold: int = local_ann_threshold):
+        self.path = path
+        self.ann_threshold = ann_threshold
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        meta = self._read_meta()
+        self.dim = meta.get('dim')
+        self.searchable = meta.get('searchable') or searchable or ['content']
+        self.description = meta.get('description')
+        self._load(meta.get('ann_rows'))
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_meta(self) -> dict:
+        if not os.path.exists(self._file('meta.json')):
+            return {}
+        with open(self._file('meta.json')) as f:
+            return json.load(f)
+
+    def _write_meta(self, **extra):
+        meta = {'dim': self.dim, 'searchable': self.searchable, 'description': self.description, **extra}
+        tmp_path = self._file('meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._file('meta.json'))
+
+    def _load(self, ann_rows: Optional[int] = None):
+        self.uuids: List[str] = []
+        self.properties: List[dict] = []
+        self._rows: Dict[str, int] = {}  # uuid -> row of its current version
+        self._alive = np.zeros(0, dtype=bool)
+        self._bm25 = {prop: BM25Index() for prop in self.searchable}
+        self._ann = None
+
+        objects, complete = [], True
+        if os.path.exists(self._file('objects.jsonl')):
+            with open(self._file('objects.jsonl')) as f:
+                for line in f:
+                    try:
+                        objects.append(json.loads(line))
+                    except ValueError:
+                        complete = False  # line cut by a crash
+                        break
+        vectors_size = os.path.getsize(self._file('vectors.f32')) if os.path.exists(self._file('vectors.f32')) else 0
+        num_vectors = vectors_size // (4 * self.dim) if self.dim else 0
+        if not complete or len(objects) != num_vectors or vectors_size != num_vectors * 4 * (self.dim or 0):
+            # interrupted write: keep the rows that have both their vector and their object, so appends stay aligned
+            objects = objects[:num_vectors]
+            logger.warning(f"{self.path} was not closed properly, keeping its first {len(objects)} objects")
+            if os.path.exists(self._file('vectors.f32')):
+                os.truncate(self._file('vectors.f32'), len(objects) * 4 * (self.dim or 0))
+            self._write_objects(objects, self._file('objects.jsonl'))
+
+        for obj in objects:
+            self._append_row(obj['uuid'], obj['properties'])
+        self._open_vectors()
+        if hnswlib and ann_rows == len(self.uuids) and os.path.exists(self._file('hnsw.bin')):
+            self._ann = hnswlib.Index(space='ip', dim=self.dim)
+            self._ann.load_index(self._file('hnsw.bin'), max_elements=len(self.uuids))
+            self._ann.set_ef(64)
+
+    @staticmethod
+    def _write_objects(objects: List[dict], path: str, mode: str = 'w'):
+        with open(path, mode) as f:
+            f.writelines(json.dumps(obj, default=_to_json) + '\n' for obj in objects)
+
+    def _append_row(self, obj_uuid: str, properties: dict):
+        row = len(self.uuids)
+        if len(self._alive) <= row:
+            self._alive = np.concatenate([self._alive, np.zeros(max(row, 1024), dtype=bool)])
+        previous = self._rows.get(obj_uuid)
+        if previous is not None:
+            self._alive[previous] = False
+            if self._ann is not None:  # the current rows are all in the HNSW index
+                self._ann.mark_deleted(previous)
+        self._rows[obj_uuid] = row
+        self._alive[row] = True
+        self.uuids.append(obj_uuid)
+        self.properties.append(properties)
+        for prop, index in self._bm25.items():
+            index.add(properties.get(prop) if isinstance(properties.get(prop), str) else '')
+
+    def _open_vectors(self):
+        rows = len(self.uuids)
+        if rows == 0:
+            self._vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+        else:
+            self._vectors = np.memmap(self._file('vectors.f32'), dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, properties: List[dict], vectors: np.ndarray, uuids: List[str]):
+        """ Adds (or replaces, same uuid) a batch of objects, and writes them to disk """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(properties), -1)
+        last = {obj_uuid: i for i, obj_uuid in enumerate(uuids)}
+        if len(last) < len(uuids):  # same uuid twice in the batch: the last one wins, the others are not written
+            keep = sorted(last.values())
+            properties, vectors, uuids = [properties[i] for i in keep], vectors[keep], [uuids[i] for i in keep]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._write_meta()
+            assert vectors.shape[1] == self.dim, f"Expected vectors of size {self.dim}"
+            # vectors first: a crash between the two writes leaves vectors without objects, dropped on load
+            with open(self._file('vectors.f32'), 'ab') as f:
+                f.write(np.ascontiguousarray(vectors).tobytes())
+            self._write_objects([{'uuid': u, 'properties': p} for u, p in zip(uuids, properties)],
+                                self._file('objects.jsonl'), mode='a')
+            first = len(self.uuids)
+            for obj_uuid, props in zip(uuids, properties):
+                self._append_row(obj_uuid, props)
+            self._open_vectors()
+            if self._ann is not None:
+                if len(self.uuids) > self._ann.get_max_elements():
+                    self._ann.resize_index(max(len(self.uuids), 2 * self._ann.get_max_elements()))
+                self._ann.add_items(vectors, np.arange(first, len(self.uuids)))
+
+    def flush(self):
+        """ Saves the HNSW index (if any), and compacts the files if more than half of the rows are replaced """
+        with self._lock:
+            if len(self.uuids) > 2 * len(self._rows) + 1000:
+                self.compact()
+            if self._ann is not None:
+                self._ann.save_index(self._file('hnsw.bin'))
+                self._write_meta(ann_rows=len(self.uuids))
+
+    def compact(self):
+        """ Rewrites the files without the replaced rows """
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:len(self.uuids)])
+            with open(self._file('vectors.f32.tmp'), 'wb') as f:
+                for start in range(0, len(rows), 10_000):
+                    f.write(np.ascontiguousarray(self._vectors[rows[start:start + 10_000]]).tobytes())
+            self._write_objects([{'uuid': self.uuids[row], 'properties': self.properties[row]} for row in rows],
+                                self._file('objects.jsonl.tmp'))
+            os.replace(self._file('vectors.f32.tmp'), self._file('vectors.f32'))
+            os.replace(self._file('objects.jsonl.tmp'), self._file('objects.jsonl'))
+            if os.path.exists(self._file('hnsw.bin')):
+                os.remove(self._file('hnsw.bin'))
+            self._write_meta()
+            self._load()
+
+    def _ann_index(self):
+        """ HNSW index of the vectors, built on the first search once the collection is large enough """
+        if hnswlib is None or len(self) < self.ann_threshold:
+            return None
+        with self._lock:
+            if self._ann is None:
+                logger.info(f"Building the HNSW index of {self.path} ({len(self)} vectors)")
+                rows = np.flatnonzero(self._alive[:len(self.uuids)])
+                index = hnswlib.Index(space='ip', dim=self.dim)  # inner product of normalized vectors = cosine
+                index.init_index(max_elements=len(self.uuids), ef_construction=128, M=32)
+                index.add_items(np.asarray(self._vectors[rows]), rows)
+                index.set_ef(64)
+                self._ann = index
+            return self._ann
+
+    def _mask(self, where: Optional[dict]) -> np.ndarray:
+        alive = self._alive[:len(self.uuids)]
+        if not where:
+            return alive
+        mask = alive.copy()
+        for row in np.flatnonzero(mask):
+            props = self.properties[row]
+            mask[row] = all(props.get(key) == value for key, value in where.items())
+        return mask
+
+    @staticmethod
+    def _top(scores: np.ndarray, mask: np.ndarray, k: int) -> np.ndarray:
+        candidates = np.flatnonzero(mask)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+    def vector_scores(self, query_vector, limit: int, where: dict = None) -> Dict[int, float]:
+        """ row -> cosine similarity of the 'limit' nearest rows """
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        with self._lock:  # an indexing job may be appending rows
+            if len(self) == 0:
+                return {}
+            ann = None if where else self._ann_index()  # filtered searches scan the vectors
+            if ann is not None:
+                labels, distances = ann.knn_query(query, k=min(limit, len(self)))
+                return {int(row): 1 - float(distance) for row, distance in zip(labels[0], distances[0])}
+            scores = self._vectors @ query
+            return {int(row): float(scores[row]) for row in self._top(scores, self._mask(where), limit)}
+
+    def keyword_scores(self, query: str, properties: List[str], limit: int, where: dict = None) -> Dict[int, float]:
+        """ row -> BM25 score (summed over the properties) of the 'limit' best rows with a positive score """
+        with self._lock:
+            mask = self._mask(where)
+            scores = np.zeros(len(self.uuids), dtype=np.float32)
+            for prop in properties:
+                if prop in self._bm25:
+                    scores += self._bm25[prop].scores(query, mask)
+            return {int(row): float(scores[row]) for row in self._top(scores, mask & (scores > 0), limit)}
+
+    def hybrid_scores(self, query: str, query_vector, properties: List[str], alpha: float,
+                      limit: int, where: dict = None, candidates: int = local_hybrid_candidates) -> Dict[int, float]:
+        """ Relative score fusion, like Weaviate: the scores of each search are scaled to [0, 1] over its results,
+            then combined as alpha * vector + (1 - alpha) * keyword
+        """
+        legs = [(alpha, self.vector_scores(query_vector, max(limit, candidates), where)),
+                (1 - alpha, self.keyword_scores(query, properties, max(limit, candidates), where))]
+        fused = {}
+        for weight, scores in legs:
+            if not scores or weight == 0:
+                continue
+            low, high = min(scores.values()), max(scores.values())
+            for row, score in scores.items():
+                fused[row] = fused.get(row, 0.0) + weight * ((score - low) / (high - low) if high > low else 1.0)
+        return dict(sorted(fused.items(), key=lambda item: -item[1])[:limit])
+
+    def objects(self, scores: Dict[int, float], return_properties: List[str] = None, metadata: str = 'score') -> List[dict]:
+        """ Properties of the rows, with their score (or distance), like WeaviateWCS.format_response """
+        results = []
+        for row, score in scores.items():
+            props = self.properties[row]
+            if return_properties:
+                props = {k: props[k] for k in return_properties if k in props}
+            value = 1 - score if metadata == 'distance' else score
+            results.append({**props, metadata: value})
+        return results
+
+
+class LocalWCS(WeaviateWCS):
+    '''
+    Same interface as WeaviateWCS (the methods used by VectorStore), but the collections are stored in a local
+    directory and searched in process: no cluster, no network round trip. Suited to single-tenant deployments
+    and offline tests. Filters are dicts of {property: value}, matched by equality.
+    '''
+    def __init__(self,
+                 path: str=local_index_dir,
+                 model_name_or_path: str='sentence-transformers/all-MiniLM-L6-v2',
+                 openai_api_key: str=None,
+                 ann_threshold: int=local_ann_threshold,
+                 **kwargs
+                 ):
+        self.path = path
+        self.ann_threshold = ann_threshold
+        self._collections: Dict[str, LocalCollection] = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        self.model_name_or_path = model_name_or_path
+        self._openai_model = False
+        if self.model_name_or_path == 'text-embedding-ada-002':
+            from openai import OpenAI
+            if not openai_api_key:
+                raise ValueError(f'OpenAI API key must be provided to use this model: {self.model_name_or_path}')
+            self._openai_client = OpenAI(api_key=openai_api_key)
+            self._openai_model = True
+        elif self.model_name_or_path:
+            from .models import get_model
+            get_model(self.model_name_or_path)  # loaded now, not held (see WeaviateWCS.model)
+        self.return_properties = None
+
+    def is_live(self) -> bool:
+        return os.path.isdir(self.path)
+
+    def is_ready(self) -> bool:
+        return self.is_live()
+
+    def connection_stats(self) -> dict:
+        return {'backend': 'local', 'collections': {name: len(c) for name, c in self._collections.items()}}
+
+    def close(self) -> None:
+        with self._lock:
+            for collection in self._collections.values():
+                collection.flush()
+
+    def get_collection(self, collection_name: str) -> LocalCollection:
+        with self._lock:
+            if collection_name not in self._collections:
+                if not os.path.isdir(os.path.join(self.path, collection_name)):
+                    raise ValueError(f'Collection "{collection_name}" not found in {self.path}')
+                self._collections[collection_name] = LocalCollection(os.path.join(self.path, collection_name),
+                                                                     ann_threshold=self.ann_threshold)
+            return self._collections[collection_name]
+
+    def create_collection(self, collection_name: str, properties: list=None, description: str=None, **kwargs) -> None:
+        path = os.path.join(self.path, collection_name)
+        if os.path.isdir(path):
+            print(f'Collection "{collection_name}" already exists')
+            return
+        # BM25 indexes for the searchable text properties (Weaviate's default for text)
+        searchable = [p.name for p in properties or [] if p.index_searchable is not False
+                      and getattr(p.data_type, 'value', p.data_type) == 'text'] or None
+        with self._lock:
+            collection = LocalCollection(path, searchable=searchable, ann_threshold=self.ann_threshold)
+            collection.description = description
+            collection._write_meta()
+            self._collections[collection_name] = collection
+        print(f'Collection "{collection_name}" created')
+
+    def show_all_collections(self, detailed: bool=False, max_details: bool=False) -> list[str] | dict:
+        names = sorted(name for name in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, name)))
+        if not detailed and not max_details:
+            return names
+        return {name: self.get_collection(name).description for name in names}
+
+    def delete_collection(self, collection_name: str) -> str:
+        with self._lock:
+            self._collections.pop(collection_name, None)
+            path = os.path.join(self.path, collection_name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+                print(f'Collection "{collection_name}" deleted')
+            else:
+                print(f'Collection "{collection_name}" not found on host')
+
+    def get_doc_count(self, collection_name: str) -> int:
+        return len(self.get_collection(collection_name))
+
+    def keyword_search(self, request: str, collection_name: str, query_properties: list[str]=['content'],
+                       limit: int=10, filter: dict=None, return_properties: list[str]=None,
+                       return_raw: bool=False) -> list[dict]:
+        collection = self.get_collection(collection_name)
+        scores = collection.keyword_scores(request, query_properties, limit, filter)
+        return collection.objects(scores, return_properties)
+
+    def vector_search(self, request: str, collection_name: str, limit: int=10, filter: dict=None,
+                      return_properties: list[str]=None, return_raw: bool=False, device: str='cpu',
+                      query_vector: list[float]=None) -> list[dict]:
+        if query_vector is None:
+            query_vector = self._create_query_vector(request, device=device)
+        collection = self.get_collection(collection_name)
+        scores = collection.vector_scores(query_vector, limit, filter)
+        return collection.objects(scores, return_properties, metadata='distance')
+
+    def hybrid_search(self, request: str, collection_name: str, query_properties: list[str]=['content'],
+                      alpha: float=0.5, limit: int=10, filter: dict=None, return_properties: list[str]=None,
+                      return_raw: bool=False, device: str='cpu', query_vector: list[float]=None) -> list[dict]:
+        if query_vector is None:
+            query_vector = self._create_query_vector(request, device=device)
+        collection = self.get_collection(collection_name)
+        scores = collection.hybrid_scores(request, query_vector, query_properties, alpha, limit, filter)
+        return collection.objects(scores, return_properties)
+
+
+class LocalIndexer:
+    '''
+    Same interface as WeaviateIndexer.batch_index_data, for a LocalWCS.
+    '''
+    def __init__(self, client: LocalWCS):
+        self.client = client
+
+    def batch_index_data(self,
+                         data: Iterable,
+                         collection_name: str,
+                         error_threshold: float=0.01,
+                         vector_property: str='content_embedding',
+                         unique_id_field: str='doc_id',
+                         uuid_field: str=None,
+                         properties: list=None,
+                         collection_description: str=None,
+                         num_objects: int=None,
+                         progress: Callable=None,
+                         batched: bool=False,
+                         batch_size: int=1000,
+                         **kwargs
+                         ) -> IndexingResult:
+        if collection_name not in self.client.show_all_collections():
+            self.client.create_collection(collection_name, properties, collection_description)
+        collection = self.client.get_collection(collection_name)
+        num_objects = len(data) if num_objects is None else num_objects
+
+        if batched:
+            objects = ((record, vector) for records, vectors in data for record, vector in zip(records, vectors))
+        else:
+            objects = (({k: v for k, v in doc.items() if k != vector_property}, doc[vector_property]) for doc in data)
+
+        start = time.perf_counter()
+        result = IndexingResult()
+        batch = []
+        for record, vector in tqdm(objects, total=num_objects):
+            batch.append((record, vector))
+            if len(batch) == batch_size:
+                self._add(collection, batch, uuid_field, progress, result)
+                batch = []
+        if batch:
+            self._add(collection, batch, uuid_field, progress, result)
+        collection.flush()
+        result.duration = time.perf_counter() - start
+        print(f'Processing finished in {round(result.duration/60, 2)} minutes, {result.objects_per_sec:.0f} objects/sec.')
+        return result
+
+    @staticmethod
+    def _add(collection: LocalCollection, batch: list, uuid_field: str, progress: Callable, result: IndexingResult):
+        records = [record for record, _ in batch]
+        uuids = [str(record.get(uuid_field) or uuid.uuid4()) if uuid_field else str(uuid.uuid4()) for record in records]
+        collection.add(records, np.stack([np.asarray(vector, dtype=np.float32) for _, vector in batch]), uuids)
+        result.num_objects += len(batch)
+        if progress:
+            progress(objects_indexed=len(batch))
@@ -0,0 +1,56 @@
+import os, re
+from typing import Optional
+
+# Company and period of a filing, stored with each of its chunks so the searches can be scoped to them.
+# They come from the upload form if given, otherwise from the name of the file, e.g.
+# AMZN_10-K_2022.pdf -> AMZN, FY2022    T-2023-Q2.pdf -> T, 2023-Q2    Apple_10K_2022.pdf -> no ticker, FY2022
+# Only a first word written in capitals is taken as a ticker: 'test.pdf' or 'Tesla 2023.pdf' are not about TEST or TESLA
+
+# first words of file names that are not tickers
+_NOT_TICKERS = {'FORM', 'FINAL', 'DRAFT', 'THE', 'FY', 'Q1', 'Q2', 'Q3', 'Q4', 'K', 'Q'}
+_QUARTER = re.compile(r'(?<![A-Z0-9])(?:Q([1-4])[\s_-]*(?:FY)?((?:19|20)\d{2})|(?:FY)?((?:19|20)\d{2})[\s_-]*Q([1-4]))(?![0-9])')
+_YEAR = re.compile(r'(?<![0-9])(?:FY[\s_-]*)?((?:19|20)\d{2})(?![0-9])')
+
+
+def normalize_ticker(ticker: Optional[str]) -> Optional[str]:
+    """ AMZN, amzn, ' Amzn ' -> AMZN (and AT&T -> ATT), None if empty """
+    ticker = re.sub(r'[^A-Z0-9.]', '', (ticker or '').upper())
+    return ticker or None
+
+
+def normalize_fiscal_period(period: Optional[str]) -> Optional[str]:
+    """ 'FY2022', '2022', 'fy 2022' -> 'FY2022'; 'Q2 2023', '2023Q2', 'q2-fy2023' -> '2023-Q2'.
+        Anything else is kept as it is (uppercased), None if empty
+    """
+    period = (period or '').strip().upper()
+    if not period:
+        return None
+    quarter = _QUARTER.search(period)
+    if quarter:
+        q1, year1, year2, q2 = quarter.groups()
+        return f"{year1 or year2}-Q{q1 or q2}"
+    year = _YEAR.fullmatch(period)
+    if year:
+        return f"FY{year.group(1)}"
+    return period
+
+
+def parse_filename(filename: str) -> dict:
+    """ Ticker and fiscal period guessed from the name of a file, None if not found """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    words = [word for word in re.split(r'[\s_\-.]+', stem) if word]
+    ticker = None
+    if words and re.fullmatch(r'[A-Z&]{1,5}', words[0]) and words[0] not in _NOT_TICKERS:  # case sensitive
+        ticker = normalize_ticker(words[0])
+    stem = stem.upper()
+
+    quarter, year = _QUARTER.search(stem), _YEAR.search(stem)
+    period = quarter.group(0) if quarter else year.group(0) if year else None
+    return {'ticker': ticker, 'fiscal_period': normalize_fiscal_period(period)}
+
+
+def file_metadata(filename: str, ticker: Optional[str] = None, fiscal_period: Optional[str] = None) -> dict:
+    """ Metadata of the chunks of a file: the values given (e.g. in the upload form) win over the file name """
+    parsed = parse_filename(filename)
+    return {'ticker': normalize_ticker(ticker) or parsed['ticker'],
+            'fiscal_period': normalize_fiscal_period(fiscal_period) or parsed['fiscal_period']}
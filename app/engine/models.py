@@ -0,0 +1,130 @@
+import time, threading
+from typing import Callable, Dict, Optional, Tuple
+
+from settings import embedding_model, model_idle_timeout, rerank_model, rerank_device
+from .logger import logger
+
+# One copy of each model per process: the upload path (chunk_embed) and the query path
+# (weaviate_interface_v4) used to load their own SentenceTransformer, i.e. twice the RAM
+# and several seconds per upload.
+
+
+def default_device() -> str:
+    from torch import cuda
+    return 'cuda' if cuda.is_available() else 'cpu'
+
+
+def _sentence_transformer(model_name: str, device: str):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, device=device)
+
+
+def _cross_encoder(model_name: str, device: str):
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name, device=device)
+
+
+def _model_memory(model) -> int:
+    """ Bytes used by the parameters and buffers of a torch module (0 if not a torch module) """
+    model = getattr(model, 'model', model)  # a CrossEncoder wraps its torch module
+    try:
+        tensors = list(model.parameters()) + list(model.buffers())
+    except AttributeError:
+        return 0
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelRegistry:
+    """ Thread-safe, lazily populated registry of models keyed by (model name, device).
+        If idle_timeout is set (seconds), models not used for that long are unloaded
+        the next time the registry is accessed (or when evict_idle() is called).
+    """
+
+    def __init__(self, idle_timeout: Optional[float] = None):
+        self.idle_timeout = idle_timeout
+        self._models: Dict[Tuple[str, str], object] = {}
+        self._last_used: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.RLock()
+        self._loading: Dict[Tuple[str, str], threading.Lock] = {}
+
+    def get(self,
+            model_name: str = embedding_model,
+            device: str = None,
+            loader: Callable[[str, str], object] = _sentence_transformer):
+        """ Returns the model, loading it on first use. Concurrent callers asking for the same
+            model wait for a single load instead of loading it several times.
+        """
+        key = (model_name, device or default_device())
+        self.evict_idle()
+
+        with self._lock:
+            if key in self._models:
+                self._last_used[key] = time.monotonic()
+                return self._models[key]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if key in self._models:  # loaded by another thread while we were waiting
+                    self._last_used[key] = time.monotonic()
+                    return self._models[key]
+
+            start = time.perf_counter()
+            model = loader(*key)
+            logger.info(f"Loaded model {key[0]} on {key[1]} in {time.perf_counter() - start:.1f}s")
+
+            with self._lock:
+                self._models[key] = model
+                self._last_used[key] = time.monotonic()
+                self._loading.pop(key, None)
+            return model
+
+    def unload(self, model_name: str, device: str = None) -> bool:
+        key = (model_name, device or default_device())
+        with self._lock:
+            self._last_used.pop(key, None)
+            model = self._models.pop(key, None)
+        if model is None:
+            return False
+        del model
+        self._release_memory(key[1])
+        logger.info(f"Unloaded model {key[0]} from {key[1]}")
+        return True
+
+    def evict_idle(self) -> int:
+        """ Unloads the models idle for more than idle_timeout, returns how many were unloaded """
+        if not self.idle_timeout:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, t in self._last_used.items() if now - t > self.idle_timeout]
+        return sum(self.unload(*key) for key in idle)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """ Bytes used by each loaded model, keyed by 'model_name@device' """
+        with self._lock:
+            models = dict(self._models)
+        return {f"{name}@{device}": _model_memory(model) for (name, device), model in models.items()}
+
+    def loaded(self) -> list:
+        with self._lock:
+            return list(self._models.keys())
+
+    @staticmethod
+    def _release_memory(device: str):
+        if device.startswith('cuda'):
+            from torch import cuda
+            cuda.empty_cache()
+
+
+model_registry = ModelRegistry(idle_timeout=model_idle_timeout)
+
+
+def get_model(model_name: str = embedding_model, device: str = None):
+    """ Shortcut to the process-wide SentenceTransformer registry """
+    return model_registry.get(model_name, device)
+
+
+def get_cross_encoder(model_name: str = rerank_model, device: str = rerank_device):
+    """ Same registry, for the CrossEncoder models used to rerank the search results """
+    return model_registry.get(model_name, device, loader=_cross_encoder)
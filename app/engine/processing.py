@@ -1,48 +1,242 @@
-import os, pickle
-from typing import List
-from engine.loaders.file import pdf_extractor
-from engine.chunk_embed import chunk_vectorize
-from settings import parquet_file
+import os, pickle, asyncio, threading
+import numpy as np
+from typing import Callable, List, Optional, Union
+from settings import embedding_model, pdf_workers, pdf_extractor_type, rerank_enabled, rerank_candidates, search_fusion
 from .logger import logger
-from .vectorstore import VectorStore
+from .cache import answer_cache
+from .rerank import reranker
+from .models import get_cross_encoder
+from .staging import staging_store
+from .ledger import ledger, chunk_id, file_hash
+from .metadata import file_metadata
 # I allow relative imports inside the engine package
 # I could have created a module but things are still changing
 
-finrag_vectorstore = VectorStore(model_path='sentence-transformers/all-mpnet-base-v2')
-    
+# the vector store (model + Weaviate connections) is created on first use, or by warm_up() when the API starts,
+# so that importing this module is fast and doesn't need the cluster
+_vectorstore = None
+_vectorstore_lock = threading.Lock()
+_vectorstore_error: Optional[str] = None
+
+
+def get_vectorstore():
+    global _vectorstore, _vectorstore_error
+    if _vectorstore is None:
+        with _vectorstore_lock:
+            if _vectorstore is None:
+                from .vectorstore import VectorStore  # imports weaviate and torch
+                try:
+                    _vectorstore = VectorStore(model_path=embedding_model)
+                    _vectorstore_error = None
+                except Exception as e:
+                    _vectorstore_error = str(e) or e.__class__.__name__
+                    raise
+    return _vectorstore
+
+
+async def aget_vectorstore():
+    """ Same as get_vectorstore, the creation (if it's not done yet) doesn't block the event loop """
+    if _vectorstore is not None:
+        return _vectorstore
+    return await asyncio.get_running_loop().run_in_executor(None, get_vectorstore)
+
+
+def warm_up():
+    """ Creates the vector store and encodes a query (and loads the reranker), so the first request doesn't pay for it """
+    get_vectorstore().encode_query('warm up')
+    if rerank_enabled:
+        get_cross_encoder(reranker.model_name, reranker.device)
+
+
+def vectorstore_state() -> str:
+    """ 'ready', 'failed: <error>' (it will be tried again on the next request) or 'starting' """
+    if _vectorstore is not None:
+        return 'ready'
+    if _vectorstore_error:
+        return f"failed: {_vectorstore_error}"
+    return 'starting'
+
+
+def connection_stats() -> dict:
+    """ Reuse statistics of the pooled Weaviate connections """
+    if _vectorstore is None:
+        return {}
+    return _vectorstore.client.connection_stats()
+
+
+def fusion_stats() -> dict:
+    """ Latencies of the keyword and vector legs of the fused searches, and of their fusion """
+    if _vectorstore is None:
+        return {}
+    return _vectorstore.fusion_stats()
+
+
+def close():
+    if _vectorstore is not None:
+        _vectorstore.client.close()
+
 
 def empty_collection():
     """ Deletes the Finrag collection if it exists """
-    status = finrag_vectorstore.empty_collection()
+    status = get_vectorstore().empty_collection()
+    answer_cache.invalidate()  # the cached answers may rely on deleted chunks
+    ledger.forget_indexed()  # so the files can be uploaded and indexed again
     return status
 
 
-def index_data():
+def _record_id(fname: str, record: dict) -> str:
+    # parts staged before the ledger existed have no chunk_id column
+    if not isinstance(record.get('chunk_id'), str):
+        record['chunk_id'] = chunk_id(fname, record['content'])
+    return record['chunk_id']
+
+
+def index_data(progress: Callable = None):
+    """ Indexes the staged chunks that are not indexed yet, progress is called with the counter objects_indexed """
     
-    if not os.path.exists(parquet_file):
-        logger.info(f"Parquet file {parquet_file} does not exists")
+    parts = staging_store.parts()
+    if not parts:
+        logger.info(f"Nothing staged in {staging_store.staging_dir}")
         return 'no data to index'
     
-    # load the parquet file into the vectorstore
-    finrag_vectorstore.index_data()
-    os.remove(parquet_file)
-    # delete the files so we can load several files and index them when we want
-    # without having to keep track of those that have been indexed already
-    # this is a simple solution for now, but we can do better
+    # only the delta is sent: the chunks indexed before a crash (or a failure) are skipped
+    # and if the ledger missed some, pushing them again is harmless since the chunk id is the uuid
+    indexed = ledger.indexed_chunks([part['name'] for part in parts])
+    sent = []  # (chunk id, part) actually consumed by the indexer (it stops early if there are too many errors)
     
+    def consumed(records, name):
+        for record in records:
+            sent.append((record['chunk_id'], name))
+            yield record
+    
+    def delta():
+        # record batches (see staging_store.iter_batches) without the chunks already indexed
+        for name, df, embeddings in staging_store.iter_batches(parts):
+            records = df.to_dict('records')
+            keep = np.array([_record_id(record['filename'], record) not in indexed for record in records], dtype=bool)
+            yield consumed([record for record, k in zip(records, keep) if k], name), embeddings[keep]
+    
+    num_objects = sum(part['rows'] for part in parts) - len(indexed)
+    result = get_vectorstore().index_data(data=delta(), num_objects=num_objects, batched=True, progress=progress)
+    answer_cache.invalidate()  # new chunks may change the context, hence the answers
+    
+    failed = set(result.doc_ids)
+    ledger.mark_chunks([(cid, name) for cid, name in sent if cid not in failed], 'indexed')
+    ledger.mark_chunks([(cid, name) for cid, name in sent if cid in failed], 'failed',
+                       error='; '.join(set(result.error_messages))[:1000] or None)
+    ledger.update_files()
+    
+    # a part is deleted once all its chunks are indexed, the others are kept for the next time
+    # (as well as the parts staged while we were indexing)
+    indexed.update(cid for cid, _ in sent if cid not in failed)
+    kept = {name for name, df, _ in staging_store.iter_batches(parts)
+            if any(_record_id(record['filename'], record) not in indexed for record in df.to_dict('records'))}
+    done = [part['name'] for part in parts if part['name'] not in kept]
+    staging_store.remove_parts(done)
+    
+    if failed or len(done) < len(parts):
+        return (f"Indexed {len(sent) - len(failed)} chunks, {len(failed)} failed (see {result.dead_letter_file}), "
+                f"{len(parts) - len(done)} parts kept")
     return "Index creation successful"
     
 
-def process_pdf(filepath:str) -> dict:
+def process_pdf(filepath: Union[str, List[str]], progress: Callable = None, 
+                ticker: str = None, fiscal_period: str = None) -> dict:
+    """ Extracts and vectorizes one or several pdf files, page by page (see vectorize_pages).
+        Files already staged or indexed (same content, whatever their name) are skipped.
+        The chunks are tagged with ticker and fiscal_period, guessed from the file names if not given.
+        Returns the number of pages and chunks of every file.
+    """
+    
+    from engine.loaders.file import pdf_extractor
+    from engine.chunk_embed import vectorize_pages
+    
+    filepaths = [filepath] if isinstance(filepath, str) else filepath
+    todo, file_hashes, metadata, skipped = [], {}, {}, {}
+    for fpath in filepaths:
+        fname, fhash = os.path.basename(fpath), file_hash(fpath)
+        state = ledger.file_state(fhash)
+        if state in ('staged', 'indexed'):
+            skipped[fname] = {'skipped': f"same content already {state}"}
+        else:
+            todo.append(fpath)
+            file_hashes[fname] = fhash
+            metadata[fname] = file_metadata(fname, ticker, fiscal_period)
+    
+    summary = {}
+    if todo:
+        pages = pdf_extractor(pdf_extractor_type, todo, num_workers=pdf_workers).iter_pages()
+        summary = vectorize_pages(pages, file_hashes=file_hashes, file_metadata=metadata, progress=progress)
+        for fname, meta in metadata.items():
+            summary.get(fname, {}).update(meta)
+        for fname, fhash in file_hashes.items():
+            ledger.stage_file(fhash, fname)
+    summary.update(skipped)
+    logger.info(f"Successfully extracted and vectorized PDF content: {summary}")
+    return summary
+
+def vector_search(question:str, rerank: bool = None, fusion: str = None, filters: dict = None) -> List[str]:
+    """ The chunks for the prompt. With reranking, more candidates are fetched and the cross-encoder picks the best.
+        fusion: 'rrf' or 'relative' to fuse the keyword and vector searches here instead of Weaviate's hybrid search
+        filters: only the chunks with these properties, e.g. {'ticker': 'AMZN'} (see VectorStore.search_filter)
+    """
     
-    new_content = pdf_extractor('PyPDFLoader', filepath).extract_text()
-    logger.info(f"Successfully extracted text from PDF")
+    rerank = rerank_enabled if rerank is None else rerank
+    fusion = search_fusion if fusion is None else fusion
+    limit = rerank_candidates if rerank else 3
+    if fusion:
+        ans = get_vectorstore().fused_search(query=question, limit=limit, alpha=0.8, method=fusion, filters=filters)
+    else:
+        ans = get_vectorstore().hybrid_search(query=question, limit=limit, alpha=0.8, filters=filters)
+    if rerank:
+        ans = reranker.rerank(question, ans, top_k=3)
+    return ans
+
+
+async def avector_search(question:str, rerank: bool = None, fusion: str = None, filters: dict = None) -> List[str]:
+    """ Same as vector_search, without blocking the event loop """
     
-    chunk_vectorize(new_content)
-    logger.info(f"Successfully vectorized PDF content")
-    return new_content
+    rerank = rerank_enabled if rerank is None else rerank
+    fusion = search_fusion if fusion is None else fusion
+    limit = rerank_candidates if rerank else 3
+    vectorstore = await aget_vectorstore()
+    if fusion:
+        ans = await vectorstore.afused_search(query=question, limit=limit, alpha=0.8, method=fusion, filters=filters)
+    else:
+        ans = await vectorstore.ahybrid_search(query=question, limit=limit, alpha=0.8, filters=filters)
+    if rerank:
+        ans = await reranker.arerank(question, ans, top_k=3)
+    return ans
+
 
-def vector_search(question:str) -> List[str]:
+async def avector_search_many(questions: List[str], rerank: bool = None, fusion: str = None, 
+                              filters: dict = None) -> List[List[str]]:
+    """ vector_search for a list of questions, encoded in one batch and searched concurrently, in order """
     
-    ans = finrag_vectorstore.hybrid_search(query=question, limit=3, alpha=0.8)
+    rerank = rerank_enabled if rerank is None else rerank
+    fusion = search_fusion if fusion is None else fusion
+    limit = rerank_candidates if rerank else 3
+    vectorstore = await aget_vectorstore()
+    if fusion:
+        vectors = await vectorstore.aencode_queries(questions)
+        ans = await asyncio.gather(*[vectorstore.afused_search(query=question, limit=limit, alpha=0.8, method=fusion,
+                                                               query_vector=vector, filters=filters)
+                                     for question, vector in zip(questions, vectors)])
+    else:
+        ans = await vectorstore.ahybrid_search_many(queries=questions, limit=limit, alpha=0.8, filters=filters)
+    if rerank:
+        ans = await asyncio.gather(*[reranker.arerank(question, candidates, top_k=3) 
+                                     for question, candidates in zip(questions, ans)])
     return ans
+
+
+async def aencode_query(question:str) -> List[float]:
+    """ Vector of the question, from the query cache if the question was just searched """
+    vectorstore = await aget_vectorstore()
+    return await vectorstore.aencode_query(question)
+
+
+async def aencode_queries(questions: List[str]) -> List[List[float]]:
+    """ Vectors of the questions, encoded together (the ones not in the query cache) """
+    vectorstore = await aget_vectorstore()
+    return await vectorstore.aencode_queries(questions)
@@ -0,0 +1,76 @@
+import time, asyncio, functools, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from settings import rerank_model, rerank_device, rerank_top_k, rerank_batch_size, rerank_budget
+from .models import get_cross_encoder
+from .cache import rerank_score_cache, normalize_query, text_hash
+from .logger import logger
+
+
+class Reranker:
+    """ Reorders search results with a cross-encoder, which reads the question and the chunk together
+        (more accurate than comparing their embeddings, but too slow to run on the whole collection).
+        - the pairs are scored in batches of 'batch_size', the scores are cached by (model, query, chunk)
+        - once 'budget' seconds are spent scoring, the remaining candidates are not scored: they come after
+          the scored ones, in their search order
+    """
+
+    def __init__(self,
+                 model_name: str = rerank_model,
+                 device: str = rerank_device,
+                 batch_size: int = rerank_batch_size,
+                 budget: float = rerank_budget):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.budget = budget
+        # one thread: the model already uses all the cores for a batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='finrag-rerank')
+        self._lock = threading.Lock()
+        self._stats = {'queries': 0, 'pairs_scored': 0, 'cache_hits': 0, 'over_budget': 0}
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self._stats[key] += value
+
+    def rerank(self, query: str, candidates: List[str], top_k: int = rerank_top_k) -> List[str]:
+        """ The top_k candidates, best first """
+        query_key = normalize_query(query)
+        keys = [(self.model_name, query_key, text_hash(chunk)) for chunk in candidates]
+        scores = [rerank_score_cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        self._count(queries=1, cache_hits=len(candidates) - len(missing))
+
+        if missing:
+            model = get_cross_encoder(self.model_name, self.device)
+            start = time.perf_counter()  # loading the model (first call, or after an idle eviction) is not counted
+            for first in range(0, len(missing), self.batch_size):
+                if time.perf_counter() - start > self.budget:
+                    logger.warning(f"Reranking over budget ({self.budget}s), "
+                                   f"{len(missing) - first} of {len(candidates)} candidates not scored")
+                    self._count(over_budget=1)
+                    break
+                batch = missing[first:first + self.batch_size]
+                batch_scores = model.predict([(query, candidates[i]) for i in batch],
+                                             batch_size=self.batch_size, show_progress_bar=False)
+                for i, score in zip(batch, batch_scores):
+                    scores[i] = float(score)
+                    rerank_score_cache.put(keys[i], scores[i])
+                self._count(pairs_scored=len(batch))
+
+        # sorted() is stable: the candidates without a score keep their search order, after the scored ones
+        order = sorted(range(len(candidates)), key=lambda i: (scores[i] is None, -(scores[i] or 0)))
+        return [candidates[i] for i in order[:top_k]]
+
+    async def arerank(self, query: str, candidates: List[str], top_k: int = rerank_top_k) -> List[str]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self.rerank, query, candidates, top_k))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+reranker = Reranker()
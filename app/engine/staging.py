@@ -0,0 +1,179 @@
+import os, json, time, uuid, threading
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+import numpy as np
+import pandas as pd
+from fastparquet import ParquetFile
+
+try:
+    import fcntl  # several uvicorn workers can stage at the same time
+except ImportError:  # not on Windows, the threading lock still protects a single process
+    fcntl = None
+
+from settings import staging_dir, parquet_file
+from .logger import logger
+
+
+def _renamed(df: pd.DataFrame) -> pd.DataFrame:
+    # the parts staged before the chunks had their metadata named the filename column 'file'
+    return df.rename(columns={'file': 'filename'}) if 'file' in df.columns else df
+
+
+class PartWriter:
+    """ Writes one part of the staging store, batch by batch.
+        Until commit() the files have temporary names and the part is invisible to the readers.
+    """
+
+    def __init__(self, store: 'StagingStore'):
+        self.store = store
+        self.name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        self.rows, self.dim = 0, None
+        self._meta_tmp = os.path.join(store.tmp_dir, self.name + '.parquet')
+        self._vectors_tmp = os.path.join(store.tmp_dir, self.name + '.f32')
+        self._vectors_file = open(self._vectors_tmp, 'wb')
+
+    def append(self, df: pd.DataFrame, embeddings: np.ndarray):
+        """ df holds the metadata columns (filename, page, content...), embeddings the (len(df), dim) vectors """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        assert embeddings.shape == (len(df), self.dim), f"Expected {len(df)} vectors of size {self.dim}"
+
+        df.to_parquet(self._meta_tmp, engine='fastparquet', append=os.path.exists(self._meta_tmp), index=False)
+        self._vectors_file.write(embeddings.tobytes())
+        self.rows += len(df)
+
+    def commit(self):
+        self._vectors_file.close()
+        if self.rows == 0:
+            self.abort()
+            return
+        os.replace(self._meta_tmp, os.path.join(self.store.staging_dir, self.name + '.parquet'))
+        os.replace(self._vectors_tmp, os.path.join(self.store.staging_dir, self.name + '.f32'))
+        self.store._add_part({'name': self.name, 'rows': self.rows, 'dim': self.dim, 'created_at': time.time()})
+
+    def abort(self):
+        self._vectors_file.close()
+        for path in (self._meta_tmp, self._vectors_tmp):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class StagingStore:
+    """ Append-only store of the chunks waiting to be indexed.
+        Every upload writes one immutable part: <part>.parquet with the metadata columns, and <part>.f32
+        with the embeddings as a raw (rows, dim) float32 matrix, read back with a memory map.
+        manifest.json lists the committed parts. It is the only file ever rewritten (atomically, under a lock),
+        so staging costs the same whatever is already staged, and concurrent uploads don't step on each other.
+    """
+
+    def __init__(self, staging_dir: str = staging_dir):
+        self.staging_dir = staging_dir
+        self.tmp_dir = os.path.join(staging_dir, 'tmp')
+        self.manifest_path = os.path.join(staging_dir, 'manifest.json')
+        self._lock = threading.Lock()
+        self._makedirs()
+        if os.path.exists(parquet_file):
+            self._import_legacy(parquet_file)
+
+    def _makedirs(self):
+        # the data directory can be erased through the API at any time
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        self._makedirs()
+        with self._lock, open(os.path.join(self.staging_dir, 'manifest.lock'), 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _read_manifest(self) -> List[dict]:
+        if not os.path.exists(self.manifest_path):
+            return []
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, parts: List[dict]):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(parts, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _add_part(self, part: dict):
+        with self._locked():
+            self._write_manifest(self._read_manifest() + [part])
+
+    @contextmanager
+    def writer(self):
+        """ with store.writer() as part: part.append(df, embeddings) ...
+            The part is committed at the end of the block, or discarded if an exception is raised
+        """
+        self._makedirs()
+        part = PartWriter(self)
+        try:
+            yield part
+        except Exception:
+            part.abort()
+            raise
+        part.commit()
+
+    def parts(self) -> List[dict]:
+        with self._locked():
+            return self._read_manifest()
+
+    def num_rows(self) -> int:
+        return sum(part['rows'] for part in self.parts())
+
+    def empty(self) -> bool:
+        return not self.parts()
+
+    def read_part(self, part: dict) -> Tuple[pd.DataFrame, np.ndarray]:
+        """ Metadata of a part, and its embeddings as a read-only memory map """
+        path = os.path.join(self.staging_dir, part['name'])
+        df = _renamed(pd.read_parquet(path + '.parquet', engine='fastparquet'))
+        embeddings = np.memmap(path + '.f32', dtype=np.float32, mode='r', shape=(part['rows'], part['dim']))
+        return df, embeddings
+
+    def iter_parts(self, parts: List[dict] = None) -> Iterator[Tuple[pd.DataFrame, np.ndarray]]:
+        """ Reads the parts one at a time (all the committed ones by default) """
+        for part in (self.parts() if parts is None else parts):
+            yield self.read_part(part)
+
+    def iter_batches(self, parts: List[dict] = None) -> Iterator[Tuple[str, pd.DataFrame, np.ndarray]]:
+        """ (part name, metadata rows, their embeddings) of the staged chunks, one row group at a time.
+            Every append of a part is a row group, so at most ingest_batch_size rows are read at once,
+            and the embeddings are slices of the memory map (nothing is copied until they are sent).
+        """
+        for part in (self.parts() if parts is None else parts):
+            path = os.path.join(self.staging_dir, part['name'])
+            embeddings = np.memmap(path + '.f32', dtype=np.float32, mode='r', shape=(part['rows'], part['dim']))
+            start = 0
+            for df in ParquetFile(path + '.parquet').iter_row_groups():
+                yield part['name'], _renamed(df), embeddings[start:start + len(df)]
+                start += len(df)
+
+    def remove_parts(self, names: List[str]):
+        names = set(names)
+        with self._locked():
+            self._write_manifest([p for p in self._read_manifest() if p['name'] not in names])
+        for name in names:
+            for ext in ('.parquet', '.f32'):
+                path = os.path.join(self.staging_dir, name + ext)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _import_legacy(self, path: str):
+        """ Moves the rows of the former single staging parquet file into a part """
+        df = pd.read_parquet(path)
+        if df.empty:
+            os.remove(path)
+            return
+        embeddings = np.asarray(df.pop('content_embedding').tolist(), dtype=np.float32)
+        with self.writer() as part:
+            part.append(df, embeddings)
+        os.remove(path)
+        logger.warning(f"Imported {len(df)} staged chunks from {path} into {self.staging_dir}")
+
+
+staging_store = StagingStore()
@@ -1,23 +1,33 @@
-import os, logging
-from typing import List, Any
+import os, time, logging, asyncio, functools, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Tuple
 import pandas as pd 
-from weaviate.classes.config import Property, DataType
+from weaviate.classes.config import Property, DataType, Tokenization
+from weaviate.classes.query import Filter
 
-from .weaviate_interface_v4 import WeaviateWCS, WeaviateIndexer
+from .weaviate_interface_v4 import WeaviateWCS, WeaviateIndexer, IndexingResult
 from .logger import logger 
+from .models import default_device
+from .staging import staging_store
+from .local_index import LocalWCS, LocalIndexer
+from .fusion import fuse
+from .metadata import normalize_ticker, normalize_fiscal_period
 
-from settings import parquet_file
+from settings import (search_workers, encode_workers, vectorstore_backend, local_index_dir, fusion_method, fusion_k,
+                      fusion_candidates)
 
 class VectorStore:
-    def __init__(self, model_path:str = 'sentence-transformers/all-mpnet-base-v2'):
+    def __init__(self, model_path:str = 'sentence-transformers/all-mpnet-base-v2', backend: str = vectorstore_backend):
         # we can create several instances to test various models, especially if we finetune one
+        # backend: 'weaviate' or 'local' (see engine/local_index.py)
         
         self.finrag_properties = [  
                 Property(name='filename',
                          data_type=DataType.TEXT,
                          description='Name of the file',
                          index_filterable=True,
-                         index_searchable=True),
+                         index_searchable=True,
+                         tokenization=Tokenization.FIELD),  # whole name: a filter on 'AMZN_2022.pdf' is exact
                 # Property(name='keywords',
                 #          data_type=DataType.TEXT_ARRAY,
                 #          description='Keywords associated with the file',
@@ -28,6 +38,32 @@ class VectorStore:
                          description='Splits of the article',
                          index_filterable=True,
                          index_searchable=True),
+                Property(name='chunk_id',
+                         data_type=DataType.TEXT,
+                         description='Id of the chunk (also its uuid), see engine/ledger.py',
+                         index_filterable=True,
+                         index_searchable=False),
+                Property(name='page',
+                         data_type=DataType.INT,
+                         description='Page of the chunk in the file, from 1',
+                         index_filterable=True),
+                Property(name='chunk_index',
+                         data_type=DataType.INT,
+                         description='Position of the chunk in the file, from 0',
+                         index_filterable=True),
+                # exact values (field tokenization), see engine/metadata.py
+                Property(name='ticker',
+                         data_type=DataType.TEXT,
+                         description='Ticker of the company, e.g. AMZN',
+                         index_filterable=True,
+                         index_searchable=False,
+                         tokenization=Tokenization.FIELD),
+                Property(name='fiscal_period',
+                         data_type=DataType.TEXT,
+                         description='Fiscal period of the report, e.g. FY2022 or 2023-Q2',
+                         index_filterable=True,
+                         index_searchable=False,
+                         tokenization=Tokenization.FIELD),
               ]
 
         self.class_name = "FinRag_all-mpnet-base-v2"
@@ -56,23 +92,37 @@ class VectorStore:
 
         self.model_path = model_path
         
-        try:
-            self.api_key = os.environ.get('FINRAG_WEAVIATE_API_KEY')
-            self.url =  os.environ.get('FINRAG_WEAVIATE_ENDPOINT')
-            self.client = WeaviateWCS(endpoint=self.url, 
-                                      api_key=self.api_key, 
-                                      model_name_or_path=self.model_path)
-            
-        except Exception as e:
-            # raise Exception(f"Could not create Weaviate client: {e}")
-            print(f"Could not create Weaviate client: {e}")
-        
-        assert self.client._client.is_live(), "Weaviate is not live"
-        assert self.client._client.is_ready(), "Weaviate is not ready"
-        # careful with accessing '_client' since the weaviate helper usually closes the connection every time
+        self.backend = backend
+        if backend == 'local':
+            # same interface as WeaviateWCS, but searched in process (no cluster needed)
+            self.client = LocalWCS(path=local_index_dir, model_name_or_path=self.model_path)
+        else:
+            try:
+                self.api_key = os.environ.get('FINRAG_WEAVIATE_API_KEY')
+                self.url =  os.environ.get('FINRAG_WEAVIATE_ENDPOINT')
+                self.client = WeaviateWCS(endpoint=self.url, 
+                                          api_key=self.api_key, 
+                                          model_name_or_path=self.model_path)
+                
+            except Exception as e:
+                # raise Exception(f"Could not create Weaviate client: {e}")
+                print(f"Could not create Weaviate client: {e}")
+        
+        assert self.client.is_live(), "Weaviate is not live"
+        assert self.client.is_ready(), "Weaviate is not ready"
+        # the connections are pooled and stay open, so checking them here doesn't cost a new handshake
         
         self.indexer = None
         
+        # the async search methods run the blocking calls here, so they don't stall the event loop
+        # queries are encoded in their own pool, so a burst of searches doesn't starve the encoder (or vice versa)
+        self._encode_executor = ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix='finrag-encode')
+        self._search_executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix='finrag-search')
+        # keyword legs of the synchronous fused searches (their vector leg runs in the calling thread)
+        self._fusion_executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix='finrag-fusion')
+        self._latencies = {}  # leg -> [number of searches, total seconds], see fusion_stats
+        self._latencies_lock = threading.Lock()
+        
         self.create_collection()
     
     @property
@@ -104,38 +154,78 @@ class VectorStore:
             return False
 
 
-    def index_data(self, data: List[dict]= None, collection_name: str='Finrag'):
+    def index_data(self, data: List[dict]= None, collection_name: str='Finrag', parts: List[dict]=None, 
+                   num_objects: int=None, batched: bool=False, progress=None) -> IndexingResult:
+        # data: documents, or record batches (property dicts, vectors) if batched, see batch_index_data
         
         if self.indexer is None:
-            self.indexer = WeaviateIndexer(self.client)
+            self.indexer = LocalIndexer(self.client) if self.backend == 'local' else WeaviateIndexer(self.client)
         
         if data is None:
-            # use the parquet file, otherwise use the data passed
-            data = pd.read_parquet(parquet_file).to_dict('records')
-            # the parquet file was created/incremented when a new article was uploaded
-            # it is a dataframe with columns: file, content, content_embedding
-            # and reflects exactly the data that we want to index at all times
-        self.status = self.indexer.batch_index_data(data, collection_name, 256)
+            # use the staging store (all its parts, or the ones given), otherwise use the data passed
+            parts = staging_store.parts() if parts is None else parts
+            data = ((df.to_dict('records'), embeddings) for _, df, embeddings in staging_store.iter_batches(parts))
+            num_objects = sum(part['rows'] for part in parts)
+            batched = True
+            # the staging parts were written when new articles were uploaded, with the columns of the properties
+            # (filename, page, chunk_index, ticker, fiscal_period, content, chunk_id) and their embeddings;
+            # they are streamed a row group at a time, so the memory doesn't grow with the staged data
+        elif num_objects is None:
+            num_objects = len(data)
+        # the chunk id is the uuid of the object, so indexing a chunk twice updates it instead of duplicating it
+        self.status = self.indexer.batch_index_data(data, collection_name, num_objects=num_objects, 
+                                                    unique_id_field='chunk_id', uuid_field='chunk_id',
+                                                    batched=batched, progress=progress)
         
-        self.num_errors, self.error_messages, self.doc_ids = self.status
-        
-        # in this case with few articles, we don't tolerate errors
-        # batch_index_data already tests errors against a threshold
-        # assert self.num_errors == 0, f"Errors: {self.num_errors}"
+        # batch_index_data already retries the failed objects and aborts above an error threshold
+        # the chunks that still failed are in self.status.doc_ids, and in the dead letter file
+        return self.status
         
         
+    def encode_query(self, query: str) -> List[float]:
+        return self.client._create_query_vector(query, device=default_device())
+    
+    
+    def encode_queries(self, queries: List[str]) -> List[List[float]]:
+        # one forward pass for all the queries that are not in the query cache
+        return self.client._create_query_vectors(queries, device=default_device())
+    
+    
+    async def _run(self, executor: ThreadPoolExecutor, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+    
+    
+    def search_filter(self, filters: Dict[str, Any] = None):
+        """ Filter of the searches from {property: value} (e.g. {'ticker': 'AMZN', 'fiscal_period': 'FY2022'}),
+            all the properties must be equal. Weaviate uses its filterable indexes, so only the matching chunks are
+            searched. The local backend takes the dict as it is. None if there is nothing to filter on.
+        """
+        filters = {name: value for name, value in (filters or {}).items() if value not in (None, '')}
+        if 'ticker' in filters:
+            filters['ticker'] = normalize_ticker(filters['ticker'])
+        if 'fiscal_period' in filters:
+            filters['fiscal_period'] = normalize_fiscal_period(filters['fiscal_period'])
+        if not filters:
+            return None
+        if self.backend == 'local':
+            return filters
+        return Filter.all_of([Filter.by_property(name).equal(value) for name, value in filters.items()])
+    
+    
     def keyword_search(self, 
                        query: str, 
                        limit: int=5, 
                        return_properties: List[str]=['filename', 'content'],
-                       alpha=None  # dummy parameter to match the hybrid_search signature
+                       alpha=None,  # dummy parameter to match the hybrid_search signature
+                       filters: Dict[str, Any]=None
                        ) -> List[str]:
         response = self.client.keyword_search(
                                 request=query,
                                 collection_name=self.collection_name,
                                 query_properties=['content'], 
                                 limit=limit,
-                                filter=None,  
+                                filter=self.search_filter(filters),  
                                 return_properties=return_properties,
                                 return_raw=False)
         
@@ -146,16 +236,19 @@ class VectorStore:
                       query: str, 
                       limit: int=5, 
                       return_properties: List[str]=['filename', 'content'],
-                      alpha=None  # dummy parameter to match the hybrid_search signature
+                      alpha=None,  # dummy parameter to match the hybrid_search signature
+                      query_vector: List[float]=None,
+                      filters: Dict[str, Any]=None
                       ) -> List[str]:
         
         response = self.client.vector_search(
                                 request=query,
                                 collection_name=self.collection_name,
                                 limit=limit,
-                                filter=None,  
+                                filter=self.search_filter(filters),  
                                 return_properties=return_properties,
-                                return_raw=False)
+                                return_raw=False,
+                                query_vector=query_vector)
         
         return [res['content'] for res in response]
     
@@ -164,7 +257,9 @@ class VectorStore:
                       query: str, 
                       limit: int=5, 
                       alpha=0.5,  # higher = more vector search
-                      return_properties: List[str]=['filename', 'content']
+                      return_properties: List[str]=['filename', 'content'],
+                      query_vector: List[float]=None,
+                      filters: Dict[str, Any]=None  # see search_filter
                       ) -> List[str]:
 
         response = self.client.hybrid_search(
@@ -173,8 +268,139 @@ class VectorStore:
                                 query_properties=['content'],
                                 alpha=alpha,  
                                 limit=limit,
-                                filter=None,  
+                                filter=self.search_filter(filters),  
                                 return_properties=return_properties,
-                                return_raw=False)
+                                return_raw=False,
+                                query_vector=query_vector)
         
-        return [res['content'] for res in response]
\ No newline at end of file
+        return [res['content'] for res in response]
+    
+    
+    def _keyword_leg(self, query: str, limit: int, return_properties: List[str], 
+                     filter: Any) -> List[Tuple[dict, float]]:
+        response = self.client.keyword_search(request=query, collection_name=self.collection_name,
+                                              query_properties=['content'], limit=limit, filter=filter,
+                                              return_properties=return_properties, return_raw=False)
+        return [(res, res.get('score', 0.0)) for res in response]
+    
+    
+    def _vector_leg(self, query: str, limit: int, return_properties: List[str], 
+                    query_vector: List[float], filter: Any) -> List[Tuple[dict, float]]:
+        response = self.client.vector_search(request=query, collection_name=self.collection_name, limit=limit,
+                                             filter=filter, return_properties=return_properties, return_raw=False,
+                                             query_vector=query_vector)
+        return [(res, 1 - res.get('distance', 0.0)) for res in response]  # cosine similarity
+    
+    
+    def _timed(self, leg: str, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._record_latency(leg, time.perf_counter() - start)
+    
+    
+    def _record_latency(self, leg: str, seconds: float):
+        with self._latencies_lock:
+            count_total = self._latencies.setdefault(leg, [0, 0.0])
+            count_total[0] += 1
+            count_total[1] += seconds
+    
+    
+    def fusion_stats(self) -> Dict[str, dict]:
+        """ Number of searches and mean latency (ms) of each leg of the fused searches """
+        with self._latencies_lock:
+            return {leg: {'searches': n, 'mean_ms': round(1000 * total / n, 2)} for leg, (n, total) in self._latencies.items()}
+    
+    
+    def _fuse(self, legs: dict, limit: int, alpha: float, method: str) -> List[str]:
+        start = time.perf_counter()
+        fused = fuse(legs, method=method, alpha=alpha, k=fusion_k)
+        self._record_latency('fusion', time.perf_counter() - start)
+        return [res['content'] for res, _ in fused[:limit]]
+    
+    
+    def fused_search(self, 
+                     query: str, 
+                     limit: int=5, 
+                     alpha=0.5,  # weight of the vector search, as in hybrid_search
+                     method: str=fusion_method,  # 'rrf' or 'relative'
+                     return_properties: List[str]=['filename', 'content', 'chunk_id'],
+                     query_vector: List[float]=None,
+                     filters: Dict[str, Any]=None
+                     ) -> List[str]:
+        """ Same results as hybrid_search, but the keyword and vector searches are sent concurrently and fused here
+            (see engine/fusion.py), so the fusion can be tuned without reindexing. Each leg fetches
+            fusion_candidates results, the chunks found by both legs appear once.
+        """
+        candidates = max(limit, fusion_candidates)
+        if query_vector is None:
+            query_vector = self.encode_query(query)
+        filter = self.search_filter(filters)
+        keyword = self._fusion_executor.submit(self._timed, 'keyword', self._keyword_leg, query, candidates, 
+                                               return_properties, filter)
+        vector = self._timed('vector', self._vector_leg, query, candidates, return_properties, query_vector, filter)
+        return self._fuse({'keyword': keyword.result(), 'vector': vector}, limit, alpha, method)
+    
+    
+    def hybrid_search_many(self, 
+                           queries: List[str], 
+                           limit: int=5, 
+                           alpha=0.5,
+                           return_properties: List[str]=['filename', 'content'],
+                           filters: Dict[str, Any]=None
+                           ) -> List[List[str]]:
+        """ hybrid_search for a list of queries: they are encoded in one batch, then searched concurrently
+            (at most search_workers Weaviate queries in flight). The results are in the order of the queries.
+        """
+        query_vectors = self.encode_queries(queries)
+        return list(self._search_executor.map(
+            lambda args: self.hybrid_search(args[0], limit, alpha, return_properties, query_vector=args[1],
+                                            filters=filters),
+            zip(queries, query_vectors)))
+    
+    
+    async def aencode_query(self, query: str) -> List[float]:
+        return await self._run(self._encode_executor, self.encode_query, query)
+    
+    
+    async def aencode_queries(self, queries: List[str]) -> List[List[float]]:
+        return await self._run(self._encode_executor, self.encode_queries, queries)
+    
+    
+    async def akeyword_search(self, query: str, limit: int=5, **kwargs) -> List[str]:
+        return await self._run(self._search_executor, self.keyword_search, query, limit, **kwargs)
+    
+    
+    async def avector_search(self, query: str, limit: int=5, **kwargs) -> List[str]:
+        query_vector = await self.aencode_query(query)
+        return await self._run(self._search_executor, self.vector_search, query, limit, 
+                               query_vector=query_vector, **kwargs)
+    
+    
+    async def ahybrid_search(self, query: str, limit: int=5, alpha=0.5, **kwargs) -> List[str]:
+        query_vector = await self.aencode_query(query)
+        return await self._run(self._search_executor, self.hybrid_search, query, limit, alpha, 
+                               query_vector=query_vector, **kwargs)
+    
+    
+    async def afused_search(self, query: str, limit: int=5, alpha=0.5, method: str=fusion_method,
+                            return_properties: List[str]=['filename', 'content', 'chunk_id'],
+                            query_vector: List[float]=None, filters: Dict[str, Any]=None) -> List[str]:
+        candidates = max(limit, fusion_candidates)
+        if query_vector is None:
+            query_vector = await self.aencode_query(query)
+        filter = self.search_filter(filters)
+        keyword, vector = await asyncio.gather(
+            self._run(self._search_executor, self._timed, 'keyword', self._keyword_leg, query, candidates, 
+                      return_properties, filter),
+            self._run(self._search_executor, self._timed, 'vector', self._vector_leg, query, candidates, 
+                      return_properties, query_vector, filter))
+        return self._fuse({'keyword': keyword, 'vector': vector}, limit, alpha, method)
+    
+    
+    async def ahybrid_search_many(self, queries: List[str], limit: int=5, alpha=0.5, **kwargs) -> List[List[str]]:
+        query_vectors = await self.aencode_queries(queries)
+        return await asyncio.gather(*[self._run(self._search_executor, self.hybrid_search, query, limit, alpha,
+                                                query_vector=query_vector, **kwargs)
+                                      for query, query_vector in zip(queries, query_vectors)])
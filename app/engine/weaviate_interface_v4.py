@@ -8,13 +8,19 @@ from weaviate.classes.config import Property
 from weaviate.classes.query import Filter
 from weaviate.config import ConnectionConfig
 from openai import OpenAI
-from sentence_transformers import SentenceTransformer
-from typing import Any
+from .models import get_model
+from .cache import query_vector_cache, normalize_query
+from .connection import WeaviateConnectionPool
+from .logger import logger
+from settings import (weaviate_pool_size, index_batch_mode, index_batch_size, index_concurrent_requests,
+                      index_requests_per_minute, index_max_retries, index_retry_backoff, dead_letter_file)
+from typing import Any, Callable
 from torch import cuda
 from tqdm import tqdm
 import time
 import os
-from dataclasses import dataclass
+import json
+from dataclasses import dataclass, field
 
 class WeaviateWCS:
     '''
@@ -37,6 +43,9 @@ class WeaviateWCS:
         https://huggingface.co/spaces/mteb/leaderboard
     openai_api_key: str=None
         The API key for the OpenAI API. Only required if using OpenAI text-embedding-ada-002 model.
+    pool_size: int=None
+        Maximum number of connections kept open and shared by concurrent callers.
+        Defaults to settings.weaviate_pool_size (always 1 for an embedded instance).
     '''    
     def __init__(self, 
                  endpoint: str=None,
@@ -45,35 +54,58 @@ class WeaviateWCS:
                  embedded: bool=False,
                  openai_api_key: str=None,
                  skip_init_checks: bool=False,
+                 pool_size: int=None,
                  **kwargs
                 ):
 
         self.endpoint = endpoint
         if embedded:
-            self._client = weaviate.connect_to_embedded(**kwargs)
+            connect = lambda: weaviate.connect_to_embedded(**kwargs)
+            pool_size = 1
         else: 
             auth_config = AuthApiKey(api_key=api_key) 
-            self._client = weaviate.connect_to_wcs(cluster_url=endpoint, 
-                                                   auth_credentials=auth_config, 
-                                                   skip_init_checks=skip_init_checks)   
+            connect = lambda: weaviate.connect_to_wcs(cluster_url=endpoint, 
+                                                      auth_credentials=auth_config, 
+                                                      skip_init_checks=skip_init_checks)   
+        # connections stay open and are reused across calls, instead of connect/close every time
+        self._pool = WeaviateConnectionPool(connect, size=pool_size or weaviate_pool_size)
+        with self._pool.connection():
+            pass  # open the first connection now, so that configuration errors show up early
         self.model_name_or_path = model_name_or_path
         self._openai_model = False
         if self.model_name_or_path == 'text-embedding-ada-002':
             if not openai_api_key:
                 raise ValueError(f'OpenAI API key must be provided to use this model: {self.model_name_or_path}')
-            self.model = OpenAI(api_key=openai_api_key)
+            self._openai_client = OpenAI(api_key=openai_api_key)
             self._openai_model = True
-        else: 
-            self.model = SentenceTransformer(self.model_name_or_path) if self.model_name_or_path else None
+        elif self.model_name_or_path:
+            get_model(self.model_name_or_path)  # loaded now, but not held: see the model property
 
         self.return_properties = ['guest', 'title', 'summary', 'content', 'video_id', 'doc_id', 'episode_url', 'thumbnail_url']
 
-    def _connect(self) -> None:
+    @property
+    def model(self):
         '''
-        Connects to Weaviate instance.
+        The query encoder, resolved through the model registry on every use: query traffic keeps it
+        from being evicted as idle, and once evicted no reference is left here to keep it in memory.
         '''
-        if not self._client.is_connected():
-            self._client.connect()
+        if self._openai_model:
+            return self._openai_client
+        return get_model(self.model_name_or_path) if self.model_name_or_path else None
+
+    def is_live(self) -> bool:
+        with self._pool.connection() as client:
+            return client.is_live()
+
+    def is_ready(self) -> bool:
+        with self._pool.connection() as client:
+            return client.is_ready()
+
+    def connection_stats(self) -> dict:
+        return self._pool.stats()
+
+    def close(self) -> None:
+        self._pool.close()
 
     def create_collection(self,
                           collection_name: str,
@@ -94,20 +126,19 @@ class WeaviateWCS:
             User-defined description of the collection.
         '''
         
-        self._connect()
-        if self._client.collections.exists(collection_name):
-            print(f'Collection "{collection_name}" already exists')
-            return 
-        else:
-            try:
-                self._client.collections.create(name=collection_name, 
-                                                properties=properties,
-                                                description=description,
-                                                **kwargs)
-                print(f'Collection "{collection_name}" created')
-            except Exception as e:
-                print(f'Error creating collection, due to: {e}')
-        self._client.close()
+        with self._pool.connection() as client:
+            if client.collections.exists(collection_name):
+                print(f'Collection "{collection_name}" already exists')
+                return 
+            else:
+                try:
+                    client.collections.create(name=collection_name, 
+                                              properties=properties,
+                                              description=description,
+                                              **kwargs)
+                    print(f'Collection "{collection_name}" created')
+                except Exception as e:
+                    print(f'Error creating collection, due to: {e}')
         return
 
     def show_all_collections(self, 
@@ -119,9 +150,8 @@ class WeaviateWCS:
         By default will only return list of collection names.
         Otherwise, increasing details about each collection can be returned.
         '''
-        self._connect()
-        collections = self._client.collections.list_all(simple=not max_details)
-        self._client.close()
+        with self._pool.connection() as client:
+            collections = client.collections.list_all(simple=not max_details)
         if not detailed and not max_details:
             return list(collections.keys())
         else:
@@ -133,54 +163,46 @@ class WeaviateWCS:
         '''
         Shows all information of a specific collection. 
         '''
-        self._connect()
-        if self._client.collections.exists(collection_name):
-            collection = self.show_all_collections(max_details=True)[collection_name]
-            self._client.close()
-            return collection
-        else: 
-            print(f'Collection "{collection_name}" not found on host')
+        with self._pool.connection() as client:
+            if client.collections.exists(collection_name):
+                return client.collections.list_all(simple=False)[collection_name]
+        print(f'Collection "{collection_name}" not found on host')
 
     def show_collection_properties(self, collection_name: str) -> dict | str:
         '''
         Shows all properties of a collection (index) on the Weaviate instance.
         '''
-        self._connect()
-        if self._client.collections.exists(collection_name):
-            collection = self.show_all_collections(max_details=True)[collection_name]
-            self._client.close()
+        collection = self.show_collection_config(collection_name)
+        if collection is not None:
             return collection.properties
-        else: 
-            print(f'Collection "{collection_name}" not found on host')
     
     def delete_collection(self, collection_name: str) -> str:
         '''
         Deletes a collection (index) on the Weaviate instance, if it exists.
         '''
-        self._connect()
-        if self._client.collections.exists(collection_name):
-            try:
-                self._client.collections.delete(collection_name)
-                self._client.close()
-                print(f'Collection "{collection_name}" deleted')
-            except Exception as e:
-                print(f'Error deleting collection, due to: {e}')
-        else: 
-            print(f'Collection "{collection_name}" not found on host')
+        with self._pool.connection() as client:
+            if client.collections.exists(collection_name):
+                try:
+                    client.collections.delete(collection_name)
+                    print(f'Collection "{collection_name}" deleted')
+                except Exception as e:
+                    print(f'Error deleting collection, due to: {e}')
+            else: 
+                print(f'Collection "{collection_name}" not found on host')
     
     def get_doc_count(self, collection_name: str) -> str:
         '''
         Returns the number of documents in a collection.
         '''
-        self._connect()
-        if self._client.collections.exists(collection_name):
-            collection = self._client.collections.get(collection_name)
-            aggregate = collection.aggregate.over_all()
-            total_count = aggregate.total_count
-            print(f'Found {total_count} documents in collection "{collection_name}"')
-            return total_count
-        else:
-            print(f'Collection "{collection_name}" not found on host')
+        with self._pool.connection() as client:
+            if client.collections.exists(collection_name):
+                collection = client.collections.get(collection_name)
+                aggregate = collection.aggregate.over_all()
+                total_count = aggregate.total_count
+                print(f'Found {total_count} documents in collection "{collection_name}"')
+                return total_count
+            else:
+                print(f'Collection "{collection_name}" not found on host')
             
     def format_response(self, 
                         response: QueryReturn,
@@ -229,15 +251,15 @@ class WeaviateWCS:
         return_raw: bool=False
             If True, returns raw response from Weaviate.
         '''
-        self._connect()
         return_properties = return_properties if return_properties else self.return_properties
-        collection = self._client.collections.get(collection_name)
-        response = collection.query.bm25(query=request,
-                                         query_properties=query_properties,
-                                         limit=limit,
-                                         filters=filter,
-                                         return_metadata=MetadataQuery(score=True),
-                                         return_properties=return_properties)
+        with self._pool.connection() as client:
+            collection = client.collections.get(collection_name)
+            response = collection.query.bm25(query=request,
+                                             query_properties=query_properties,
+                                             limit=limit,
+                                             filters=filter,
+                                             return_metadata=MetadataQuery(score=True),
+                                             return_properties=return_properties)
         # response = response.with_where(where_filter).do() if where_filter else response.do()
         if return_raw:
             return response
@@ -251,7 +273,8 @@ class WeaviateWCS:
                       return_properties: list[str]=None,
                       filter: Filter=None,
                       return_raw: bool=False,
-                      device: str='cuda:0' if cuda.is_available() else 'cpu'
+                      device: str='cuda:0' if cuda.is_available() else 'cpu',
+                      query_vector: list[float]=None
                       ) -> dict | list[dict]:
         '''
         Executes vector search using embedding model defined on instantiation 
@@ -272,16 +295,19 @@ class WeaviateWCS:
             If True, returns raw response from Weaviate.
         device: str
             Device to use for encoding query.
+        query_vector: list[float]=None
+            Vector of the query, if it was already encoded (the query is not encoded again).
         '''
-        self._connect()
         return_properties = return_properties if return_properties else self.return_properties
-        query_vector = self._create_query_vector(request, device=device)
-        collection = self._client.collections.get(collection_name)
-        response = collection.query.near_vector(near_vector=query_vector,
-                                                limit=limit,
-                                                filters=filter,
-                                                return_metadata=MetadataQuery(distance=True),                                                               
-                                                return_properties=return_properties)
+        if query_vector is None:
+            query_vector = self._create_query_vector(request, device=device)
+        with self._pool.connection() as client:
+            collection = client.collections.get(collection_name)
+            response = collection.query.near_vector(near_vector=query_vector,
+                                                    limit=limit,
+                                                    filters=filter,
+                                                    return_metadata=MetadataQuery(distance=True),                                                               
+                                                    return_properties=return_properties)
         #  response = response.with_where(where_filter).do() if where_filter else response.do()
         if return_raw:
             return response
@@ -291,9 +317,37 @@ class WeaviateWCS:
     def _create_query_vector(self, query: str, device: str) -> list[float]:
         '''
         Creates embedding vector from text query.
-        '''
-        return self.get_openai_embedding(query) if self._openai_model else self.model.encode(query, device=device).tolist()
+        Vectors are cached by (model, normalized query), so repeated questions skip the encoder
+        (and the OpenAI API call).
+        '''
+        key = (self.model_name_or_path, normalize_query(query))
+        vector = query_vector_cache.get(key)
+        if vector is None:
+            vector = self.get_openai_embedding(query) if self._openai_model else self.model.encode(query, device=device).tolist()
+            query_vector_cache.put(key, vector)
+        return vector
     
+    def _create_query_vectors(self, queries: list[str], device: str) -> list[list[float]]:
+        '''
+        Same as _create_query_vector for a list of queries: the ones not in the cache are encoded
+        together, in one call to the model (or to the OpenAI API).
+        '''
+        keys = [(self.model_name_or_path, normalize_query(query)) for query in queries]
+        vectors = [query_vector_cache.get(key) for key in keys]
+        missing = {key: query for key, query, vector in zip(keys, queries, vectors) if vector is None}
+        if missing:
+            texts = list(missing.values())
+            if self._openai_model:
+                response = self.model.embeddings.create(input=texts, model='text-embedding-ada-002')
+                encoded = [item.embedding for item in response.data]
+            else:
+                encoded = self.model.encode(texts, device=device).tolist()
+            for key, vector in zip(missing, encoded):
+                query_vector_cache.put(key, vector)
+            encoded = dict(zip(missing, encoded))
+            vectors = [encoded[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        return vectors
+
     def get_openai_embedding(self, query: str) -> list[float]:
         '''
         Gets embedding from OpenAI API for query.
@@ -313,7 +367,8 @@ class WeaviateWCS:
                       filter: Filter=None,
                       return_properties: list[str]=None,
                       return_raw: bool=False,
-                      device: str='cuda:0' if cuda.is_available() else 'cpu'
+                      device: str='cuda:0' if cuda.is_available() else 'cpu',
+                      query_vector: list[float]=None
                      ) -> dict | list[dict]:
         '''
         Executes Hybrid (Keyword + Vector) search.
@@ -341,25 +396,49 @@ class WeaviateWCS:
             If None, returns all properties.
         return_raw: bool=False
             If True, returns raw response from Weaviate.
+        device: str
+            Device to use for encoding query.
+        query_vector: list[float]=None
+            Vector of the query, if it was already encoded (the query is not encoded again).
         '''
-        self._connect()
         return_properties = return_properties if return_properties else self.return_properties
-        query_vector = self._create_query_vector(request, device=device)
-        collection = self._client.collections.get(collection_name)
-        response = collection.query.hybrid(query=request,
-                                           query_properties=query_properties,
-                                           filters=filter,
-                                           vector=query_vector,
-                                           alpha=alpha,
-                                           limit=limit,
-                                           return_metadata=MetadataQuery(score=True, distance=True),
-                                           return_properties=return_properties)
+        if query_vector is None:
+            query_vector = self._create_query_vector(request, device=device)
+        with self._pool.connection() as client:
+            collection = client.collections.get(collection_name)
+            response = collection.query.hybrid(query=request,
+                                               query_properties=query_properties,
+                                               filters=filter,
+                                               vector=query_vector,
+                                               alpha=alpha,
+                                               limit=limit,
+                                               return_metadata=MetadataQuery(score=True, distance=True),
+                                               return_properties=return_properties)
         if return_raw:
             return response
         else: 
             return self.format_response(response)
         
         
+@dataclass
+class IndexingResult:
+    '''
+    Outcome of WeaviateIndexer.batch_index_data.
+    '''
+    num_objects: int = 0  # objects sent (fewer than the data if the job was aborted)
+    num_errors: int = 0  # objects that still failed after the retries
+    num_retried: int = 0  # objects sent again, summed over the attempts
+    completed: bool = True  # False if the error threshold was exceeded and the job aborted
+    duration: float = 0.0  # seconds
+    error_messages: list[str] = field(default_factory=list)
+    doc_ids: list = field(default_factory=list)  # unique ids of the failed objects
+    dead_letter_file: str = None  # where the failed objects were saved
+
+    @property
+    def objects_per_sec(self) -> float:
+        return self.num_objects / self.duration if self.duration else 0.0
+
+
 class WeaviateIndexer:
 
     def __init__(self,
@@ -370,14 +449,7 @@ class WeaviateIndexer:
         this class will automatically configure the Weaviate batch client.
         '''
     
-        self._client = client._client
-
-    def _connect(self):
-        '''
-        Connects to Weaviate instance.
-        '''
-        if not self._client.is_connected():
-            self._client.connect()
+        self._pool = client._pool  # share the connections of the client
 
     def create_collection(self, 
                           collection_name: str, 
@@ -391,37 +463,59 @@ class WeaviateIndexer:
         if collection_name.find('-') != -1:
             raise ValueError('Collection name cannot contain hyphens')
         try:
-            self._connect()
-            self._client.collections.create(name=collection_name,
-                                            description=description,
-                                            properties=properties,
-                                            **kwargs
-                                            )
-            if self._client.collections.exists(collection_name):
-                print(f'Collection "{collection_name}" created')
-            else:
-                print(f'Collection not found at the moment, try again later')
-            self._client.close()
+            with self._pool.connection() as client:
+                client.collections.create(name=collection_name,
+                                          description=description,
+                                          properties=properties,
+                                          **kwargs
+                                          )
+                if client.collections.exists(collection_name):
+                    print(f'Collection "{collection_name}" created')
+                else:
+                    print(f'Collection not found at the moment, try again later')
         except Exception as e:
             print(f'Error creating collection, due to: {e}')
 
+    def _batch(self, collection, batch_mode: str, batch_size: int, concurrent_requests: int, requests_per_minute: int):
+        if batch_mode == 'fixed_size':
+            return collection.batch.fixed_size(batch_size=batch_size, concurrent_requests=concurrent_requests)
+        if batch_mode == 'rate_limit':
+            return collection.batch.rate_limit(requests_per_minute=requests_per_minute)
+        if batch_mode == 'dynamic':
+            return collection.batch.dynamic()
+        raise ValueError(f"Unknown batch mode: {batch_mode}, use 'fixed_size', 'rate_limit' or 'dynamic'")
+
     def batch_index_data(self,
                          data: list[dict], 
                          collection_name: str,
                          error_threshold: float=0.01,
                          vector_property: str='content_embedding', 
                          unique_id_field: str='doc_id',
+                         uuid_field: str=None,
                          properties: list[Property]=None,
                          collection_description: str=None,
+                         num_objects: int=None,
+                         progress: Callable=None,
+                         batched: bool=False,
+                         batch_mode: str=index_batch_mode,
+                         batch_size: int=index_batch_size,
+                         concurrent_requests: int=index_concurrent_requests,
+                         requests_per_minute: int=index_requests_per_minute,
+                         max_retries: int=index_max_retries,
+                         retry_backoff: float=index_retry_backoff,
+                         dead_letter_file: str=dead_letter_file,
                          **kwargs
-                         ) -> dict:
+                         ) -> 'IndexingResult':
         '''
         Batch function for fast indexing of data onto Weaviate cluster. 
+        The data is streamed: only the objects of the batches in flight are held in memory.
         
         Args
         ----
         data: list[dict]
-            List of dictionaries where each dictionary represents a document.
+            List (or iterator) of dictionaries where each dictionary represents a document.
+            If batched, iterator of record batches instead: (list of property dicts, matrix of their vectors),
+            e.g. the row groups of the staging store. The property dicts are sent as they are, without copy.
         collection_name: str
             Name of the collection to index data into.
         error_threshold: float=0.01
@@ -432,19 +526,38 @@ class WeaviateIndexer:
             Name of the property that contains the vector representation of the document.
         unique_id_field: str='doc_id'
             Name of the unique identifier field in the document.
+        uuid_field: str=None
+            If given, name of the field holding the uuid of each object. Indexing an object with an existing
+            uuid replaces it, so the same documents can be indexed again without creating duplicates.
         properties: list[Property]=None
             List of properties to create the collection with. Required if collection does not exist.
         collection_description: str=None
             Description of the collection. Optional parameter.
+        num_objects: int=None
+            Number of documents, required if data is an iterator.
+        progress: Callable=None
+            If given, called every 100 objects as progress(objects_indexed=100) (and for the remainder at the end).
+        batched: bool=False
+            True if data is made of record batches (see data).
+        batch_mode: str='fixed_size'
+            'fixed_size' (batch_size objects per request, concurrent_requests requests in flight),
+            'rate_limit' (at most requests_per_minute requests) or 'dynamic' (sizes adapted by the client).
+        max_retries: int=3
+            Number of times the failed objects are sent again, after the others.
+        retry_backoff: float=1.0
+            Seconds to wait before the first retry, doubled at every attempt.
+        dead_letter_file: str
+            jsonl file where the objects that still failed after the retries are appended (None = not saved).
         
         Returns
         -------
-        dict
-            Dictionary containing error information if any with the following keys: 
-            ['num_errors', 'error_messages', 'doc_ids']
+        IndexingResult
+            Number of objects sent, of errors and retries, the error messages and the ids of the failed 
+            objects (their unique_id_field), throughput.
         '''
-        self._connect()
-        if not self._client.collections.exists(collection_name):
+        with self._pool.connection() as client:
+            collection_exists = client.collections.exists(collection_name)
+        if not collection_exists:
             print(f'Collection "{collection_name}" not found on host, creating Collection first...')
             if properties is None:
                 raise ValueError(f'Tried to create Collection <{collection_name}> but no properties were provided.')
@@ -452,43 +565,96 @@ class WeaviateIndexer:
                                    properties=properties,
                                    description=collection_description,
                                    **kwargs)
-            self._client.close()
 
-        self._connect()
-        error_threshold_size = int(len(data) * error_threshold)
-        collection = self._client.collections.get(collection_name)
+        num_objects = len(data) if num_objects is None else num_objects
+        error_threshold_size = int(num_objects * error_threshold)
+
+        if batched:
+            objects = ((record, vector) for records, vectors in data for record, vector in zip(records, vectors))
+        else:
+            objects = (({k:v for k,v in doc.items() if k != vector_property}, doc[vector_property]) for doc in data)
 
-        start = time.perf_counter()
-        completed_job = True
+        start = last_report = time.perf_counter()
+        result = IndexingResult()
         
-        with collection.batch.dynamic() as batch:
-            for doc in tqdm(data):
-                batch.add_object(properties={k:v for k,v in doc.items() if k != vector_property},
-                                 vector=doc[vector_property])
-                if batch.number_errors > error_threshold_size:
-                    print('Upload errors exceed error_threshold...')
-                    completed_job = False
-                    break 
-        end = time.perf_counter() - start
-        print(f'Processing finished in {round(end/60, 2)} minutes.')
+        with self._pool.connection() as client:
+            collection = client.collections.get(collection_name)
+            i = 0
+            with self._batch(collection, batch_mode, batch_size, concurrent_requests, requests_per_minute) as batch:
+                for i, (record, vector) in enumerate(tqdm(objects, total=num_objects), 1):
+                    batch.add_object(properties=record,
+                                     vector=vector,
+                                     uuid=record.get(uuid_field) if uuid_field else None)
+                    if i % 100 == 0:
+                        if progress:
+                            progress(objects_indexed=100)
+                        if time.perf_counter() - last_report > 10:
+                            last_report = time.perf_counter()
+                            logger.info(f'Indexed {i}/{num_objects} objects, '
+                                        f'{i / (last_report - start):.0f} objects/sec')
+                    if batch.number_errors > error_threshold_size:
+                        print('Upload errors exceed error_threshold...')
+                        result.completed = False
+                        break 
+                if progress and i % 100:
+                    progress(objects_indexed=i % 100)
+            failed_objects = collection.batch.failed_objects
+            # the failed objects are retried once the stream is sent, so a few failures don't slow it down
+            failed_objects = self._retry_failed(collection, failed_objects, max_retries, retry_backoff, result)
         
-        failed_objects = collection.batch.failed_objects
-        if any(failed_objects):
-            error_messages = [obj.message for obj in failed_objects]
-            doc_ids = [obj.object_.properties.get(unique_id_field, 'Not Found') for obj in failed_objects] 
-        else:
-            error_messages, doc_ids = [], []
-        error_object = {'num_errors':batch.number_errors, 
-                        'error_messages': error_messages,
-                        'doc_ids': doc_ids}
-        if not completed_job:
-            print(f'Batch job failed. Review errors using these keys: {list(error_object.keys())}')
-            return error_object
-        if batch.number_errors > 0:
-                print(f'Batch job completed with {batch.number_errors} errors.  Review errors using these keys: {list(error_object.keys())}')
+        result.num_objects = i
+        result.duration = time.perf_counter() - start
+        result.num_errors = len(failed_objects)
+        result.error_messages = [obj.message for obj in failed_objects]
+        result.doc_ids = [obj.object_.properties.get(unique_id_field, 'Not Found') for obj in failed_objects]
+        if failed_objects and dead_letter_file:
+            self._dead_letter(dead_letter_file, collection_name, failed_objects)
+            result.dead_letter_file = dead_letter_file
+        print(f'Processing finished in {round(result.duration/60, 2)} minutes, {result.objects_per_sec:.0f} objects/sec.')
+        
+        if not result.completed:
+            print(f'Batch job failed after {i} objects, {result.num_errors} errors. Review them in result.error_messages')
+        elif result.num_errors > 0:
+            print(f'Batch job completed with {result.num_errors} errors ({result.num_retried} objects retried). '
+                  f'Review them in result.error_messages')
         else:
-            print('Batch job completed with zero errors.')
-        return error_object
+            print(f'Batch job completed with zero errors ({result.num_retried} objects retried).')
+        return result
+
+    def _retry_failed(self, collection, failed_objects: list, max_retries: int, backoff: float, 
+                      result: 'IndexingResult') -> list:
+        '''
+        Sends the failed objects again (with their uuid, so nothing is duplicated), waiting 
+        backoff * 2**attempt seconds before each attempt. Returns the objects that still failed.
+        '''
+        for attempt in range(max_retries):
+            if not failed_objects:
+                break
+            time.sleep(backoff * 2 ** attempt)
+            logger.warning(f'Retrying {len(failed_objects)} failed objects (attempt {attempt + 1}/{max_retries})')
+            result.num_retried += len(failed_objects)
+            with collection.batch.fixed_size(batch_size=100, concurrent_requests=1) as batch:
+                for obj in failed_objects:
+                    batch.add_object(properties=obj.object_.properties,
+                                     vector=obj.object_.vector,
+                                     uuid=obj.object_.uuid)
+            failed_objects = collection.batch.failed_objects
+        return failed_objects
+
+    @staticmethod
+    def _dead_letter(path: str, collection_name: str, failed_objects: list):
+        '''
+        Appends the objects that could not be indexed to a jsonl file, one line per object (without its vector).
+        '''
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            for obj in failed_objects:
+                f.write(json.dumps({'collection': collection_name,
+                                    'uuid': str(obj.object_.uuid),
+                                    'properties': obj.object_.properties,
+                                    'error': obj.message,
+                                    'failed_at': time.time()}, default=str) + '\n')
+        logger.error(f'{len(failed_objects)} objects could not be indexed, see {path}')
             
 
 @dataclass
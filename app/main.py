@@ -1,23 +1,66 @@
 
-import os, random, logging, pickle, shutil
+import os, json, time, random, asyncio, logging, pickle, shutil
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv, find_dotenv
-from typing import Optional
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
 
-from fastapi import FastAPI, HTTPException, File, UploadFile, status
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, File, Form, UploadFile, status
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-
-from engine.processing import process_pdf, index_data, empty_collection, vector_search
-from rag.rag import rag_it
+from fastapi.concurrency import run_in_threadpool
+
+from engine.processing import (process_pdf, index_data, empty_collection, avector_search, avector_search_many,
+                               aencode_query, aencode_queries, connection_stats, fusion_stats, warm_up, vectorstore_state,
+                               close)
+from engine.models import model_registry
+from engine.cache import query_vector_cache, answer_cache
+from engine.jobs import JobManager
+from engine.ledger import ledger
+from engine.rerank import reranker
+from rag.rag import rag_it, arag_it, arag_it_stream
+from rag.client_pool import llm_pool
+from rag.context import context_stats
 
 from engine.logger import logger
 
-from settings import datadir
+from settings import (datadir, state_files, upload_chunk_size, max_batch_questions, ragit_batch_concurrency, 
+                      warm_up_on_startup)
 
 os.makedirs(datadir, exist_ok=True)
 
-app = FastAPI()
+started_at = time.time()
+warm_up_task = None
+
+
+def _log_warm_up(task: asyncio.Task):
+    if task.cancelled():
+        logger.warning("Warm-up cancelled (shutdown), the first request will load what is missing")
+    elif task.exception() is not None:
+        logger.error(f"Warm-up failed, will try again on the next request: {task.exception()}")
+    else:
+        logger.info(f"Warmed up in {time.time() - started_at:.1f}s")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ The model and the Weaviate connections are loaded in the background once the server is up:
+        it answers /health/live right away, and /health/ready once they are ready.
+        The jobs interrupted by the previous run are started again here, not when main is imported
+    """
+    global warm_up_task
+    jobs.resume()
+    if warm_up_on_startup:
+        warm_up_task = asyncio.create_task(run_in_threadpool(warm_up))
+        warm_up_task.add_done_callback(_log_warm_up)
+    yield
+    if warm_up_task and not warm_up_task.done():
+        warm_up_task.cancel()
+    close()
+    await llm_pool.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 environment = os.getenv("ENVIRONMENT", "dev")  # created by dockerfile
 
@@ -37,6 +80,9 @@ try:
 except Exception as e:
     pass 
 
+# extraction/embedding and indexing run in the background, the requests only return a job id
+jobs = JobManager(handlers={'upload': process_pdf, 'index': index_data})
+
 
 @app.get("/", response_class=HTMLResponse)
 def read_root():
@@ -57,10 +103,54 @@ def ping():
     return {"answer": str(int(random.random() * 100))}
 
 
+@app.get("/health/live")
+def health_live():
+    """ The process is up and serving requests (doesn't wait for the warm-up) """
+    return {"status": "alive", "uptime": round(time.time() - started_at, 1)}
+
+
+@app.get("/health/ready")
+def health_ready():
+    """ 200 once the vector store (model and Weaviate connections) is ready, 503 while it warms up or if it failed """
+    state = vectorstore_state()
+    body = {"status": "ready" if state == 'ready' else "not ready", "vectorstore": state, 
+            "uptime": round(time.time() - started_at, 1)}
+    if state != 'ready':
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=body)
+    return body
+
+
+@app.get("/models/")
+def list_models():
+    """ Models loaded in this process and their memory footprint in MB """
+    usage = model_registry.memory_usage()
+    return {"models": {name: round(size / 2**20, 1) for name, size in usage.items()}}
+
+
+@app.get("/stats/")
+def stats():
+    """ Hit rates of the in-memory caches, reuse of the Weaviate connections, LLM calls and retries, reranking,
+        search results and tokens that went into the prompts,
+        latencies of the fused searches (per leg), files and chunks of the indexing ledger by state """
+    return {"query_vectors": query_vector_cache.stats(),
+            "answers": answer_cache.stats(),
+            "weaviate_connections": connection_stats(),
+            "llm_calls": llm_pool.stats(),
+            "context": context_stats.stats(),
+            "rerank": reranker.stats(),
+            "fusion": fusion_stats(),
+            "index_ledger": ledger.stats()}
+
+
+def data_files() -> List[str]:
+    """ The files uploaded to the data directory, without the state files (with their -journal, .tmp, ...) """
+    return [name for name in os.listdir(datadir) if not name.startswith(state_files)]
+
+
 @app.delete("/erase_data/")
 def erase_data():
     """ Erase all files in the data directory, but not the vector store """
-    if len(os.listdir(datadir)) == 0:
+    if len(data_files()) == 0:
         logger.info("No data to erase")
         return {"message": "No data to erase"}
     
@@ -82,15 +172,34 @@ def delete_vectors():
 @app.get("/list_files/")
 def list_files():
     """ List all files in the data directory """
-    files = os.listdir(datadir)
+    files = data_files()
     logger.info(f"Files in data directory: {files}")
     return {"files": files}
 
 
+async def save_upload(file: UploadFile, filepath: str):
+    """ Streams the upload to disk chunk by chunk, the file is never fully in memory.
+        It's written under a temporary name first, so a failed upload doesn't leave a partial pdf behind.
+    """
+    tmp_path = filepath + '.part'
+    try:
+        with open(tmp_path, 'wb') as f:
+            while chunk := await file.read(upload_chunk_size):
+                f.write(chunk)
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 @app.post("/upload/")
 # @limiter.limit("5/minute") see 'slowapi' for rate limiting
-async def upload_file(file: UploadFile = File(...)):
-    """  Uploads a file in data directory, for later indexing """
+async def upload_file(file: UploadFile = File(...), 
+                      ticker: Optional[str] = Form(None), 
+                      fiscal_period: Optional[str] = Form(None)):
+    """  Uploads a file in data directory, for later indexing.
+         ticker and fiscal_period (e.g. AMZN, FY2022 or 2023-Q2) tag its chunks, guessed from the file name if not given
+    """
     try:
         filepath = os.path.join(datadir, file.filename)
         logger.info(f"Fiename detected: {file.filename}")
@@ -98,9 +207,10 @@ async def upload_file(file: UploadFile = File(...)):
             logger.warning(f"File {file.filename} already exists: no processing done")
             return {"message": f"File {file.filename} already exists: no processing done"}    
 
-        else:
+        elif file.filename.endswith('.pdf'):
+            # let's save the file in /data even if it's temp storage on HF
             logger.info(f"Receiving file: {file.filename}")
-            contents = await file.read()
+            await save_upload(file, filepath)
             logger.info(f"File reception complete!")
             
     except Exception as e:
@@ -108,63 +218,220 @@ async def upload_file(file: UploadFile = File(...)):
         return {"message": f"Error during file upload:  {str(e)}"}
     
     if file.filename.endswith('.pdf'):
-        
-        # let's save the file in /data even if it's temp storage on HF
-        with open(filepath, 'wb') as f:
-            f.write(contents)
-                
-        try:
-            logger.info(f"Starting to process {file.filename}")
-            new_content = process_pdf(filepath)
-            success = {"message": f"Successfully uploaded {file.filename}"}
-            success.update(new_content)
-            return success
-        
-        except Exception as e:
-            return {"message": f"Failed to extract text from PDF: {str(e)}"}
+        job = jobs.submit('upload', filepath=filepath, ticker=ticker, fiscal_period=fiscal_period)
+        logger.info(f"Processing of {file.filename} queued as job {job.id}")
+        return {"message": f"Successfully uploaded {file.filename}, processing it in job {job.id}", 
+                "job_id": job.id}
     else:
         return {"message": "Only PDF files are accepted"}
 
 
+@app.post("/upload_batch/")
+async def upload_files(files: List[UploadFile] = File(...), 
+                       ticker: Optional[str] = Form(None), 
+                       fiscal_period: Optional[str] = Form(None)):
+    """ Uploads several files in data directory, they are processed together (in parallel) in one job.
+        ticker and fiscal_period apply to all the files, see /upload/
+    """
+    messages, filepaths = {}, []
+    for file in files:
+        filepath = os.path.join(datadir, file.filename)
+        if not file.filename.endswith('.pdf'):
+            messages[file.filename] = "Only PDF files are accepted"
+        elif os.path.exists(filepath):
+            logger.warning(f"File {file.filename} already exists: no processing done")
+            messages[file.filename] = "File already exists: no processing done"
+        else:
+            await save_upload(file, filepath)
+            filepaths.append(filepath)
+    
+    if not filepaths:
+        return {"message": messages}
+    
+    job = jobs.submit('upload', filepath=filepaths, ticker=ticker, fiscal_period=fiscal_period)
+    logger.info(f"Processing of {len(filepaths)} files queued as job {job.id}")
+    messages.update({os.path.basename(fp): "Successfully uploaded" for fp in filepaths})
+    return {"message": messages, "job_id": job.id}
+
+
 @app.post("/create_index/")
 async def create_index():
-    """ Create an index for the uploaded files """
+    """ Create an index for the uploaded files, in the background """
     
     logger.info("Creating index for uploaded files")
-    try:
-        msg = index_data()
-        return {"message": msg}
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    job = jobs.submit('index')
+    return {"message": f"Indexing in job {job.id}", "job_id": job.id}
+
+
+@app.get("/jobs/")
+def list_jobs():
+    """ Recent jobs, with their status and progress """
+    return {"jobs": jobs.list()}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """ Status (queued, running, done, failed), progress (pages_parsed, chunks_embedded, objects_indexed)
+        and result of a job
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found")
+    return job
+
+
+class SearchFilters(BaseModel):
+    """ The search only looks at the chunks with all these values (exact match), e.g. {"ticker": "AMZN"} """
+    filename: Optional[str] = None
+    page: Optional[int] = None
+    ticker: Optional[str] = None
+    fiscal_period: Optional[str] = None  # FY2022, 2023-Q2 (Q2 2023 works too)
+    
+    def to_dict(self) -> dict:
+        return self.model_dump(exclude_none=True)
 
 
 class Question(BaseModel):
     question: str
+    filters: SearchFilters = SearchFilters()
+    rerank: Optional[bool] = None  # rerank the search results with the cross-encoder (None = server default)
+    fusion: Optional[Literal['rrf', 'relative']] = None  # fuse keyword and vector searches here (None = server default)
 
 @app.post("/ask/")
 async def hybrid_search(question: Question):
     logger.info(f"Processing question: {question.question}")
     try:
-        search_results = vector_search(question.question) 
+        search_results = await avector_search(question.question, rerank=question.rerank, fusion=question.fusion,
+                                              filters=question.filters.to_dict()) 
         logger.info(f"Answer: {search_results}")
         return {"answer": search_results}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     
     
+class Questions(BaseModel):
+    questions: List[str]
+    filters: SearchFilters = SearchFilters()  # for all the questions
+    rerank: Optional[bool] = None
+    fusion: Optional[Literal['rrf', 'relative']] = None
+
+@app.post("/ask_batch/")
+async def hybrid_search_batch(questions: Questions):
+    """ Same as /ask/ for a list of questions: they are encoded together and searched concurrently.
+        The answers are in the order of the questions.
+    """
+    if len(questions.questions) > max_batch_questions:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, 
+                            detail=f"At most {max_batch_questions} questions per call")
+    logger.info(f"Processing {len(questions.questions)} questions")
+    try:
+        search_results = await avector_search_many(questions.questions, rerank=questions.rerank,
+                                                    fusion=questions.fusion,
+                                                    filters=questions.filters.to_dict())
+        return {"answers": search_results}
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    
+    
 @app.post("/ragit/")
 async def ragit(question: Question):
     logger.info(f"Processing question: {question.question}")
     try:
-        search_results = vector_search(question.question) 
+        search_results = await avector_search(question.question, rerank=question.rerank, fusion=question.fusion,
+                                              filters=question.filters.to_dict()) 
         logger.info(f"Search results generated: {search_results}")
         
-        answer = rag_it(question.question, search_results)
+        # same (or very close) question with the same context -> same answer, no need to ask the LLM
+        query_vector = await aencode_query(question.question)
+        answer = answer_cache.lookup(query_vector, search_results)
+        if answer is None:
+            answer = await run_in_threadpool(rag_it, question.question, search_results)
+            answer_cache.store(query_vector, search_results, answer)
+        else:
+            logger.info("Answer found in the semantic cache")
         
         logger.info(f"Answer: {answer}")
         return {"answer": answer}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@app.post("/ragit_batch/")
+async def ragit_batch(questions: Questions):
+    """ Same as /ragit/ for a list of questions: the searches are done in bulk (see /ask_batch/), then the
+        LLM is called concurrently (at most ragit_batch_concurrency calls in flight, and the rate limit of
+        the provider). Every answer comes with its question, and an error if it failed (the others still succeed).
+    """
+    if len(questions.questions) > max_batch_questions:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, 
+                            detail=f"At most {max_batch_questions} questions per call")
+    logger.info(f"Processing {len(questions.questions)} questions")
+    try:
+        search_results = await avector_search_many(questions.questions, rerank=questions.rerank,
+                                                    fusion=questions.fusion,
+                                                    filters=questions.filters.to_dict())
+        query_vectors = await aencode_queries(questions.questions)  # from the query cache, after the searches
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    
+    semaphore = asyncio.Semaphore(ragit_batch_concurrency)
+    
+    async def answer(question: str, results: List[str], query_vector: List[float]) -> dict:
+        cached = answer_cache.lookup(query_vector, results)
+        if cached is not None:
+            return {"question": question, "answer": cached}
+        try:
+            async with semaphore:
+                response = await arag_it(question, results)
+        except Exception as e:
+            logger.error(f"Error answering '{question}': {str(e)}")
+            return {"question": question, "answer": None, "error": str(e)}
+        answer_cache.store(query_vector, results, response)
+        return {"question": question, "answer": response}
+    
+    answers = await asyncio.gather(*[answer(*args) for args in 
+                                     zip(questions.questions, search_results, query_vectors)])
+    return {"answers": answers}
+
+
+def sse_event(event: str, data) -> str:
+    """ Formats a Server-Sent Event, data is json encoded so it can contain new lines """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/ragit_stream/")
+async def ragit_stream(question: Question):
+    """ Same as /ragit/, streamed as Server-Sent Events: 
+        'sources' (the search results) first, then one 'token' event per chunk of the answer, 
+        and 'done' at the end ('error' if something fails along the way)
+    """
+    logger.info(f"Processing question (streaming): {question.question}")
+
+    async def events():
+        try:
+            search_results = await avector_search(question.question, rerank=question.rerank, fusion=question.fusion,
+                                                  filters=question.filters.to_dict())
+            yield sse_event("sources", search_results)
+            
+            query_vector = await aencode_query(question.question)
+            answer = answer_cache.lookup(query_vector, search_results)
+            if answer is not None:
+                yield sse_event("token", answer)
+            else:
+                tokens = []
+                async for token in arag_it_stream(question.question, search_results):
+                    tokens.append(token)
+                    yield sse_event("token", token)
+                answer_cache.store(query_vector, search_results, ''.join(tokens))
+            yield sse_event("done", "")
+        except Exception as e:
+            logger.error(f"Error while streaming the answer: {str(e)}")
+            yield sse_event("error", str(e))
+
+    return StreamingResponse(events(), 
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    
     
 if __name__ == '__main__':
     import uvicorn
@@ -178,8 +445,10 @@ if __name__ == '__main__':
 
 # Examples:
 # curl -X POST "http://localhost:80/upload" -F "file=@test.pdf"
+# curl -X POST "http://localhost:80/upload_batch/" -F "files=@test.pdf" -F "files=@test2.pdf"
 # curl -X DELETE "http://localhost:80/erase_data/"
 # curl -X GET "http://localhost:80/list_files/" 
+# curl -X GET "http://localhost:80/jobs/<job_id>"
 
 # hf space is at https://jpbianchi-finrag.hf.space/ 
 # code given by https://jpbianchi-finrag.hf.space/docs
@@ -188,3 +457,6 @@ if __name__ == '__main__':
 
 # curl -X POST http://localhost:80/ask/ -H "Content-Type: application/json" -d '{"question": "what is Amazon loss"}' 
 # curl -X POST http://localhost:80/ragit/ -H "Content-Type: application/json" -d '{"question": "Does ATT have postpaid phone customers?"}'
+# curl -X POST http://localhost:80/ask/ -H "Content-Type: application/json" -d '{"question": "what is the net loss", "filters": {"ticker": "AMZN", "fiscal_period": "FY2022"}}'
+# curl -X POST "http://localhost:80/upload/" -F "file=@test.pdf" -F "ticker=AMZN" -F "fiscal_period=FY2022"
+# curl -N -X POST http://localhost:80/ragit_stream/ -H "Content-Type: application/json" -d '{"question": "Does ATT have postpaid phone customers?"}'
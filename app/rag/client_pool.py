@@ -0,0 +1,288 @@
+import time, random, asyncio, threading
+from contextlib import contextmanager, asynccontextmanager
+from typing import Callable, Dict, Optional
+
+import httpx
+import litellm
+
+from settings import (llm_max_connections, llm_max_concurrency, llm_timeout, llm_max_retries, llm_backoff,
+                      llm_requests_per_minute)
+
+# errors worth retrying: rate limits, timeouts, 5xx (not every litellm version has all of them)
+_RETRYABLE = tuple(getattr(litellm, name) for name in ('RateLimitError', 'Timeout', 'APIConnectionError',
+                                                       'ServiceUnavailableError', 'InternalServerError')
+                   if hasattr(litellm, name))
+
+
+class TokenBucket:
+    """ Rate limiter: 'rate' requests per second on average, with bursts of up to 'capacity' requests """
+
+    def __init__(self, requests_per_minute: float, capacity: float = None):
+        self.rate = requests_per_minute / 60
+        self.capacity = capacity or max(1.0, self.rate)  # one second worth of requests
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """ Takes a token, returns how long to wait (seconds) before the request can be sent """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # can go negative: the next callers wait for their turn
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ReleasingStream:
+    """ Streamed LLM response that gives back its concurrency slot (release) once the stream
+        is exhausted, fails or is closed, since the call lasts until the last token is read
+    """
+
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    def _done(self):
+        if self._release is not None:
+            self._release, release = None, self._release
+            release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except BaseException:  # StopAsyncIteration included
+            self._done()
+            raise
+
+    async def aclose(self):
+        try:
+            close = getattr(self._stream, 'aclose', None)
+            if close is not None:
+                await close()
+        finally:
+            self._done()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class ReleasingIterator:
+    """ Same as ReleasingStream, for the streamed responses of the sync calls """
+
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    def _done(self):
+        if self._release is not None:
+            self._release, release = None, self._release
+            release()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._stream)
+        except BaseException:  # StopIteration included
+            self._done()
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self._stream, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._done()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class LLMClientPool:
+    """ HTTP sessions, concurrency limits and retries shared by all the LLM calls of the process.
+        - litellm reuses our keep-alive sessions instead of creating HTTP clients per call
+        - at most 'max_concurrency' calls in flight per provider (sync and async counted separately)
+        - every call has a timeout and is retried with exponential backoff (and jitter) on transient errors
+        - if requests_per_minute is set, the calls to each provider are spread to stay under that rate
+    """
+
+    def __init__(self,
+                 max_connections: int = llm_max_connections,
+                 max_concurrency: int = llm_max_concurrency,
+                 timeout: float = llm_timeout,
+                 max_retries: int = llm_max_retries,
+                 backoff: float = llm_backoff,
+                 requests_per_minute: Optional[float] = llm_requests_per_minute):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._http_limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        litellm.client_session = httpx.Client(limits=self._http_limits, timeout=timeout)
+
+        self._lock = threading.Lock()
+        self._limits: Dict[str, threading.BoundedSemaphore] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        # the async session and semaphores belong to an event loop (uvicorn only has one)
+        self._loop = None
+        self._asession: Optional[httpx.AsyncClient] = None
+        self._alimits: Dict[str, asyncio.Semaphore] = {}
+        self._stats = {'calls': 0, 'retries': 0, 'failures': 0, 'throttled': 0}
+
+    @staticmethod
+    def provider(model_name: str) -> str:
+        if '/' in model_name:
+            return model_name.split('/')[0]  # litellm style, e.g. 'anthropic/claude-3-haiku-20240307'
+        if model_name.startswith('claude'):
+            return 'anthropic'
+        if model_name.startswith('command'):
+            return 'cohere'
+        return 'openai'
+
+    def _semaphore(self, provider: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            return self._limits.setdefault(provider, threading.BoundedSemaphore(self.max_concurrency))
+
+    @contextmanager
+    def limit(self, provider: str):
+        with self._semaphore(provider):
+            yield
+
+    def _throttle(self, provider: str) -> float:
+        """ Seconds to wait before calling the provider, to respect requests_per_minute """
+        if not self.requests_per_minute:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.setdefault(provider, TokenBucket(self.requests_per_minute))
+        delay = bucket.reserve()
+        if delay:
+            self._count('throttled')
+        return delay
+
+    async def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._loop is loop:
+                return
+            previous, previous_loop = self._asession, self._loop
+            self._asession = httpx.AsyncClient(limits=self._http_limits, timeout=self.timeout)
+            litellm.aclient_session = self._asession
+            self._alimits = {}
+            self._loop = loop
+        if previous is not None:
+            # the connections of the previous loop are of no use here: close them, where they can still be closed
+            if previous_loop.is_running():  # in another thread
+                asyncio.run_coroutine_threadsafe(self._close_session(previous), previous_loop)
+            else:
+                await self._close_session(previous)
+
+    @staticmethod
+    async def _close_session(session: httpx.AsyncClient):
+        try:
+            await session.aclose()
+        except RuntimeError:  # sockets of a loop already closed: nothing more we can do
+            pass
+
+    async def aclose(self):
+        """ Closes the async HTTP session, at shutdown (the sync one is process-wide) """
+        with self._lock:
+            session, self._asession, self._loop = self._asession, None, None
+            self._alimits = {}
+        if session is not None:
+            await self._close_session(session)
+
+    async def _asemaphore(self, provider: str) -> asyncio.Semaphore:
+        await self._bind_loop()
+        with self._lock:
+            return self._alimits.setdefault(provider, asyncio.Semaphore(self.max_concurrency))
+
+    @asynccontextmanager
+    async def alimit(self, provider: str):
+        async with await self._asemaphore(provider):
+            yield
+
+    def _delay(self, attempt: int) -> float:
+        return self.backoff * 2 ** attempt * (0.5 + random.random())
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _prepare(self, kwargs: dict):
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('max_retries', 0)  # the retries are done here, not nested in the provider SDK
+
+    def _send(self, fn, model: str, kwargs: dict):
+        semaphore = self._semaphore(self.provider(model))
+        semaphore.acquire()
+        streaming = False
+        try:
+            time.sleep(self._throttle(self.provider(model)))
+            response = fn(model=model, **kwargs)
+            if kwargs.get('stream'):
+                response, streaming = ReleasingIterator(response, semaphore.release), True
+            return response
+        finally:
+            if not streaming:  # otherwise released by the stream
+                semaphore.release()
+
+    def call(self, fn, model: str, **kwargs):
+        """ Calls fn (litellm.completion) under the limits of the model's provider, with retries.
+            A streamed response keeps its slot until it is exhausted or closed (see ReleasingIterator)
+        """
+        self._prepare(kwargs)
+        for attempt in range(self.max_retries + 1):
+            self._count('calls')
+            try:
+                return self._send(fn, model, kwargs)
+            except _RETRYABLE:
+                if attempt == self.max_retries:
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                time.sleep(self._delay(attempt))
+
+    async def _asend(self, fn, model: str, kwargs: dict):
+        semaphore = await self._asemaphore(self.provider(model))
+        await semaphore.acquire()
+        streaming = False
+        try:
+            await asyncio.sleep(self._throttle(self.provider(model)))
+            response = await fn(model=model, **kwargs)
+            if kwargs.get('stream'):
+                response, streaming = ReleasingStream(response, semaphore.release), True
+            return response
+        finally:
+            if not streaming:  # otherwise released by the stream
+                semaphore.release()
+
+    async def acall(self, fn, model: str, **kwargs):
+        """ Same as call, for coroutines (litellm.acompletion).
+            A streamed response keeps its slot until it is exhausted or closed (see ReleasingStream)
+        """
+        self._prepare(kwargs)
+        for attempt in range(self.max_retries + 1):
+            self._count('calls')
+            try:
+                return await self._asend(fn, model, kwargs)
+            except _RETRYABLE:
+                if attempt == self.max_retries:
+                    self._count('failures')
+                    raise
+                self._count('retries')
+                await asyncio.sleep(self._delay(attempt))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+llm_pool = LLMClientPool()
@@ -0,0 +1,154 @@
+import functools, threading
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from settings import (context_token_budget, context_token_budgets, context_dedup_threshold, context_min_overlap,
+                      embedding_model)
+
+# Packs the search results into the context of the prompt, most relevant first:
+# 1. near-duplicates (restated filings, the same chunk uploaded twice) are dropped, by embedding similarity
+# 2. chunks that overlap (consecutive splits of the same page, see iter_splits) are merged into one
+# 3. the chunks are added until the token budget of the model is spent
+# tiktoken is imported on first use, like in engine/chunk_embed.py
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:  # not an OpenAI model: close enough to count the tokens
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def token_budget(model: str) -> int:
+    return context_token_budgets.get(model, context_token_budget)
+
+
+def embed_chunks(chunks: List[str]) -> np.ndarray:
+    # the search results were embedded when they were indexed, so most come from the embedding cache of the uploads:
+    # it is only read here (no put, no flush from the query path), the few misses are encoded and not kept
+    from engine.models import get_model
+    from engine.cache import get_embedding_cache
+    model = get_model(embedding_model)
+    dim = model.get_sentence_embedding_dimension()
+    cache = get_embedding_cache(embedding_model, dim)
+    if cache is None:
+        vectors, hit = np.zeros((len(chunks), dim), dtype=np.float32), np.zeros(len(chunks), dtype=bool)
+    else:
+        vectors, hit = cache.lookup(chunks)
+    missing = np.flatnonzero(~hit)
+    if len(missing):
+        vectors[missing] = model.encode([chunks[i] for i in missing], convert_to_numpy=True, show_progress_bar=False)
+    return vectors
+
+
+def drop_near_duplicates(chunks: List[str],
+                         embed: Callable[[List[str]], np.ndarray] = embed_chunks,
+                         threshold: float = context_dedup_threshold) -> List[str]:
+    """ Keeps the first of the chunks whose embeddings are more similar (cosine) than threshold """
+    chunks = list(dict.fromkeys(chunks))  # exact duplicates first, no need to embed them
+    if len(chunks) < 2:
+        return chunks
+    vectors = np.asarray(embed(chunks), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+    similarities = vectors @ vectors.T
+    kept = []
+    for i in range(len(chunks)):
+        if all(similarities[i, j] < threshold for j in kept):
+            kept.append(i)
+    return [chunks[i] for i in kept]
+
+
+def overlap(first: str, second: str, min_chars: int = context_min_overlap) -> int:
+    """ Length of the longest end of first that is also the start of second (0 if shorter than min_chars) """
+    if len(first) < min_chars or len(second) < min_chars:
+        return 0
+    head = second[:min_chars]
+    start = first.find(head)
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(head, start + 1)
+    return 0
+
+
+def merge_overlapping(chunks: List[str], min_chars: int = context_min_overlap) -> List[str]:
+    """ Merges the chunks that continue each other (in either order), the merged chunk takes the place
+        of the most relevant one
+    """
+    merged = list(chunks)
+    i = 0
+    while i < len(merged):
+        for j in range(i + 1, len(merged)):
+            if n := overlap(merged[i], merged[j], min_chars):
+                merged[i] = merged[i] + merged[j][n:]
+            elif n := overlap(merged[j], merged[i], min_chars):
+                merged[i] = merged[j] + merged[i][n:]
+            else:
+                continue
+            del merged[j]
+            break  # the merged chunk may continue another one
+        else:
+            i += 1
+    return merged
+
+
+def fill_budget(chunks: List[str], model: str, budget: int) -> List[str]:
+    """ The chunks that fit in budget tokens, in order. The ones too long are skipped for the next ones,
+        the first one is truncated if it doesn't fit on its own
+    """
+    packed, used = [], 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk, model)
+        if used + tokens <= budget:
+            packed.append(chunk)
+            used += tokens
+        elif not packed:
+            encoding = get_encoding(model)
+            packed.append(encoding.decode(encoding.encode(chunk)[:budget]))
+            used = budget
+    return packed
+
+
+class ContextStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {'contexts': 0, 'results': 0, 'near_duplicates': 0, 'merged': 0, 'over_budget': 0,
+                       'tokens_in': 0, 'tokens_out': 0}
+
+    def count(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self._stats[key] += value
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+context_stats = ContextStats()
+
+
+def pack_context(search_results: List[str],
+                 model: str,
+                 budget: Optional[int] = None,
+                 embed: Callable[[List[str]], np.ndarray] = embed_chunks) -> List[str]:
+    """ The search results to put in the prompt of model, within budget tokens (the budget of the model if None) """
+    budget = token_budget(model) if budget is None else budget
+    unique = drop_near_duplicates(search_results, embed)
+    merged = merge_overlapping(unique)
+    packed = fill_budget(merged, model, budget)
+    context_stats.count(contexts=1,
+                        results=len(search_results),
+                        near_duplicates=len(search_results) - len(unique),
+                        merged=len(unique) - len(merged),
+                        over_budget=len(merged) - len(packed),
+                        tokens_in=sum(count_tokens(result, model) for result in search_results),
+                        tokens_out=sum(count_tokens(chunk, model) for chunk in packed))
+    return packed
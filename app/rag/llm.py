@@ -2,7 +2,9 @@
 
 from litellm import completion, acompletion
 from litellm.utils import CustomStreamWrapper, ModelResponse
-import os
+import os, threading
+
+from .client_pool import llm_pool
 
 class LLM:
     '''
@@ -87,15 +89,17 @@ class LLM:
             {'role': secondary_role, 'content': user_message}
                     ]
         
-        response = completion(model=self.model_name,
-                              messages=messages,
-                              temperature=temperature,
-                              max_tokens=max_tokens,
-                              stream=stream,
-                              api_key=self._api_key,
-                              api_base=self.api_base,
-                              api_version=self.api_version,
-                              **kwargs)
+        # pooled HTTP connections, per-provider concurrency limit, timeout and retries
+        response = llm_pool.call(completion,
+                                 model=self.model_name,
+                                 messages=messages,
+                                 temperature=temperature,
+                                 max_tokens=max_tokens,
+                                 stream=stream,
+                                 api_key=self._api_key,
+                                 api_base=self.api_base,
+                                 api_version=self.api_version,
+                                 **kwargs)
         
         if raw_response or stream:
             return response
@@ -135,15 +139,31 @@ class LLM:
             {'role': initial_role, 'content': system_message},
             {'role': 'user', 'content': user_message}
                     ]
-        response = await acompletion(model=self.model_name,
-                                     messages=messages,
-                                     temperature=temperature,
-                                     max_tokens=max_tokens,
-                                     stream=stream,
-                                     api_key=self._api_key,
-                                     api_base=self.api_base,
-                                     api_version=self.api_version,
-                                     **kwargs)
+        response = await llm_pool.acall(acompletion,
+                                        model=self.model_name,
+                                        messages=messages,
+                                        temperature=temperature,
+                                        max_tokens=max_tokens,
+                                        stream=stream,
+                                        api_key=self._api_key,
+                                        api_base=self.api_base,
+                                        api_version=self.api_version,
+                                        **kwargs)
         if raw_response or stream:
             return response
-        return response.choices[0].message.content
\ No newline at end of file
+        return response.choices[0].message.content
+
+
+_llms = {}
+_llms_lock = threading.Lock()
+
+
+def get_llm(model_name: str='gpt-3.5-turbo-0125', **kwargs) -> LLM:
+    '''
+    Returns a long-lived LLM instance, created on the first call for these arguments.
+    '''
+    key = (model_name, tuple(sorted(kwargs.items())))
+    with _llms_lock:
+        if key not in _llms:
+            _llms[key] = LLM(model_name, **kwargs)
+        return _llms[key]
@@ -1,17 +1,15 @@
+import asyncio
+from typing import AsyncIterator, List, Tuple
 
-from typing import List 
-
-from .llm import LLM
+from .llm import get_llm
+from .context import pack_context
 #the LLM Class uses the OPENAI_API_KEY env var as the default api_key 
 
 
-def rag_it(question: str,
-           search_results: List[str], 
-           model: str = 'gpt-3.5-turbo-0125', 
-           ) -> str:
-
-    # TODO turn this into a class if time allows
-    llm = LLM(model)
+def build_prompt(question: str, search_results: List[str]) -> Tuple[str, str]:
+    """ Returns the system message and the user prompt for a question and its search results
+        (already packed, see pack_context)
+    """
 
     system_message = """
     You are a financial analyst, with a deep expertise in financial reports.
@@ -46,11 +44,68 @@ def rag_it(question: str,
     ------------------------
     Answer:\n
     """.format(searches=searches, question=question)
+    
+    return system_message, user_prompt
 
 
+def rag_it(question: str,
+           search_results: List[str], 
+           model: str = 'gpt-3.5-turbo-0125', 
+           ) -> str:
+
+    # TODO turn this into a class if time allows
+    llm = get_llm(model)  # reused across requests, with its pooled connections
+
+    # no duplicates, and no more tokens than the budget of the model
+    context = pack_context(search_results, model)
+    system_message, user_prompt = build_prompt(question, context)
+
     response = llm.chat_completion(system_message=system_message,
                                    user_message=user_prompt,
                                    temperature=0.01,  # let's not allow the model to be creative
                                    stream=False,
                                    raw_response=False)
-    return response
\ No newline at end of file
+    return response
+
+
+async def arag_it(question: str,
+                  search_results: List[str], 
+                  model: str = 'gpt-3.5-turbo-0125', 
+                  ) -> str:
+    """ Same as rag_it, without blocking the event loop (so many questions can be answered concurrently) """
+
+    llm = get_llm(model)
+
+    context = await asyncio.to_thread(pack_context, search_results, model)  # embeds and tokenizes
+    system_message, user_prompt = build_prompt(question, context)
+
+    response = await llm.achat_completion(system_message=system_message,
+                                          user_message=user_prompt,
+                                          temperature=0.01,
+                                          stream=False,
+                                          raw_response=False)
+    return response
+
+
+async def arag_it_stream(question: str,
+                         search_results: List[str], 
+                         model: str = 'gpt-3.5-turbo-0125', 
+                         ) -> AsyncIterator[str]:
+    """ Same as rag_it, but yields the answer token by token as the LLM generates it """
+
+    llm = get_llm(model)
+
+    context = await asyncio.to_thread(pack_context, search_results, model)  # embeds and tokenizes
+    system_message, user_prompt = build_prompt(question, context)
+
+    response = await llm.achat_completion(system_message=system_message,
+                                          user_message=user_prompt,
+                                          temperature=0.01,
+                                          stream=True)
+    try:
+        async for chunk in response:
+            token = chunk.choices[0].delta.content
+            if token:
+                yield token
+    finally:
+        await response.aclose()  # the client may leave before the end: give the LLM slot back
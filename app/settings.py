@@ -1,4 +1,94 @@
 import os
 
 datadir = '../data'  # will be used in main.py
-parquet_file = os.path.join(datadir, 'text_vectors.parquet') # used by the files in 'engine'
+staging_dir = os.path.join(datadir, 'staging')  # chunks and embeddings waiting to be indexed, see engine/staging.py
+parquet_file = os.path.join(datadir, 'text_vectors.parquet')  # former staging file, imported in staging_dir if found
+ledger_file = os.path.join(datadir, 'ledger.sqlite')  # state of every uploaded file and staged chunk
+
+embedding_model = 'sentence-transformers/all-mpnet-base-v2'
+# load the model and connect to the vector store in the background when the API starts (otherwise on first use)
+warm_up_on_startup = os.getenv('FINRAG_WARM_UP', '1') != '0'
+# models not used for that many seconds are unloaded (None = keep them forever)
+model_idle_timeout = float(os.getenv('FINRAG_MODEL_IDLE_TIMEOUT', 0)) or None
+# splits encoded per forward pass when chunking (None = adapt to the free memory)
+embedding_batch_size = int(os.getenv('FINRAG_EMBEDDING_BATCH_SIZE', 0)) or None
+# on-disk cache of split embeddings, next to the staged data (size 0 = no cache)
+embedding_cache_dir = os.path.join(datadir, 'embedding_cache')
+embedding_cache_size = int(os.getenv('FINRAG_EMBEDDING_CACHE_SIZE', 100_000))  # number of vectors
+# in-memory cache of the query vectors
+query_cache_size = int(os.getenv('FINRAG_QUERY_CACHE_SIZE', 4096))
+query_cache_ttl = float(os.getenv('FINRAG_QUERY_CACHE_TTL', 24 * 3600)) or None  # seconds
+# search backend: 'weaviate' (remote cluster, see FINRAG_WEAVIATE_ENDPOINT) or 'local' (in process, see engine/local_index.py)
+vectorstore_backend = os.getenv('FINRAG_VECTORSTORE_BACKEND', 'weaviate')
+local_index_dir = os.getenv('FINRAG_LOCAL_INDEX_DIR', '../local_index')  # not in datadir: /erase_data/ keeps the vector store
+local_ann_threshold = 50_000  # vectors above which the local backend searches an HNSW index (if hnswlib is installed)
+local_hybrid_candidates = 100  # results of each search fused by the local hybrid search
+# long-lived Weaviate connections shared by the requests
+weaviate_pool_size = int(os.getenv('FINRAG_WEAVIATE_POOL_SIZE', 4))
+weaviate_health_check_interval = 30.0  # seconds a connection can stay idle before being checked
+weaviate_pool_timeout = 30.0  # seconds to wait for a free connection
+# threads running the blocking searches and query encodings for the async endpoints
+search_workers = weaviate_pool_size
+encode_workers = 2
+max_batch_questions = int(os.getenv('FINRAG_MAX_BATCH_QUESTIONS', 1000))  # per call of the batch endpoints
+# answers reused for questions this similar (cosine) to a cached one, with the same search results
+answer_cache_size = int(os.getenv('FINRAG_ANSWER_CACHE_SIZE', 1024))
+answer_cache_threshold = float(os.getenv('FINRAG_ANSWER_CACHE_THRESHOLD', 0.95))
+# reranking: the search fetches rerank_candidates chunks, a cross-encoder scores them (on CPU, in batches)
+# and the best rerank_top_k go into the prompt; past rerank_budget seconds, the chunks not scored yet keep their order
+rerank_enabled = os.getenv('FINRAG_RERANK', '1') != '0'  # default, can be switched per request
+rerank_model = os.getenv('FINRAG_RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+rerank_device = 'cpu'
+rerank_candidates = 20
+rerank_top_k = 3
+rerank_batch_size = 16
+rerank_budget = float(os.getenv('FINRAG_RERANK_BUDGET', 0.5))  # seconds
+rerank_cache_size = 50_000  # (query, chunk) scores
+# client-side fusion: the keyword and vector searches run concurrently, each fetches fusion_candidates results,
+# fused by reciprocal rank ('rrf', with constant fusion_k) or by normalized scores ('relative').
+# Unset: Weaviate's hybrid search (default, can be switched per request)
+search_fusion = os.getenv('FINRAG_SEARCH_FUSION') or None
+if search_fusion not in (None, 'rrf', 'relative'):  # fail at startup rather than on every search
+    raise ValueError(f"FINRAG_SEARCH_FUSION must be 'rrf' or 'relative' (or unset), not {search_fusion!r}")
+fusion_method = search_fusion or 'rrf'
+fusion_k = 60
+fusion_candidates = 50
+# LLM calls: pooled HTTP connections, concurrency per provider, timeout (seconds) and retries
+llm_max_connections = 50
+llm_max_concurrency = int(os.getenv('FINRAG_LLM_MAX_CONCURRENCY', 8))
+llm_timeout = float(os.getenv('FINRAG_LLM_TIMEOUT', 60))
+llm_max_retries = 3
+llm_backoff = 0.5  # seconds, doubled after every retry
+llm_requests_per_minute = float(os.getenv('FINRAG_LLM_REQUESTS_PER_MINUTE', 0)) or None  # per provider (None = no limit)
+ragit_batch_concurrency = int(os.getenv('FINRAG_RAGIT_BATCH_CONCURRENCY', 16))  # LLM calls in flight per /ragit_batch/
+# context of the prompt (see rag/context.py): search results this similar (cosine) to a more relevant one are dropped,
+# overlapping ones are merged, and the rest fills the token budget of the model, most relevant first
+context_token_budget = int(os.getenv('FINRAG_CONTEXT_TOKEN_BUDGET', 3000))  # models not in context_token_budgets
+context_token_budgets = {'gpt-3.5-turbo': 3000, 'gpt-3.5-turbo-0125': 3000, 'gpt-3.5-turbo-1106': 3000,
+                         'gpt-4-turbo-preview': 8000, 'gpt-4-0125-preview': 8000, 'gpt-4-1106-preview': 8000}
+context_dedup_threshold = 0.95
+context_min_overlap = 40  # characters shared by the end of a chunk and the start of the next one (20-token overlap)
+# pdf text extraction: worker processes, and pages per task (large files are split in page ranges)
+pdf_workers = int(os.getenv('FINRAG_PDF_WORKERS', min(os.cpu_count() or 1, 8)))
+pdf_pages_per_task = 25
+pdf_extractor_type = os.getenv('FINRAG_PDF_EXTRACTOR', 'PyPDFLoader')  # or 'PyMuPDF' (faster)
+# splits going through the ingestion pipeline together (embedded, then appended to the staging part)
+ingest_batch_size = 512
+upload_chunk_size = 2**20  # bytes read at a time when an upload is written to disk
+# batches sent to Weaviate when indexing: 'fixed_size' (index_batch_size objects per request, with
+# index_concurrent_requests requests in flight), 'rate_limit' (index_requests_per_minute) or 'dynamic'
+index_batch_mode = os.getenv('FINRAG_INDEX_BATCH_MODE', 'fixed_size')
+index_batch_size = int(os.getenv('FINRAG_INDEX_BATCH_SIZE', 200))
+index_concurrent_requests = int(os.getenv('FINRAG_INDEX_CONCURRENT_REQUESTS', 2))
+index_requests_per_minute = int(os.getenv('FINRAG_INDEX_REQUESTS_PER_MINUTE', 600))
+index_max_retries = 3  # the objects that failed are sent again, with exponential backoff
+index_retry_backoff = 1.0  # seconds, doubled after every retry
+dead_letter_file = os.path.join(datadir, 'dead_letter.jsonl')  # objects that could not be indexed
+# background jobs (uploads and indexing), saved to disk so they survive a restart
+jobs_file = os.path.join(datadir, 'jobs.json')
+ingest_workers = int(os.getenv('FINRAG_INGEST_WORKERS', 2))
+job_concurrency = {'index': 1}  # max jobs of a kind running at once (indexing the same collection twice makes no sense)
+max_finished_jobs = 100  # finished jobs kept for /jobs/
+# state of the app kept in datadir next to the uploaded files: not listed by /list_files/, and not data to erase
+state_files = tuple(os.path.basename(path) for path in (staging_dir, parquet_file, ledger_file, embedding_cache_dir,
+                                                        dead_letter_file, jobs_file))
@@ -0,0 +1,25 @@
+import sys
+sys.path.append("../")
+
+from rag.context import pack_context, merge_overlapping, count_tokens
+
+# the embeddings are given: no model needed
+
+
+def test_pack_context():
+    page = ("Total revenue for the year was 514 billion dollars, an increase of 9 percent. "
+            "Operating income decreased to 12 billion dollars. The net loss was 2.7 billion dollars, "
+            "or 0.27 dollars per diluted share, compared with a net income of 33 billion dollars in 2021.")
+    first, second = page[:180], page[120:]  # consecutive splits, with some overlap
+    assert merge_overlapping([second, "Unrelated chunk about AT&T customers.", first]) == \
+        [page, "Unrelated chunk about AT&T customers."]
+
+    def embed(chunks):  # the restated chunk has the same vector as the original
+        return [[1.0, 0.0, 0.0] if chunk.startswith(first) else [0.0, 1.0, 0.0] if 'AT&T' in chunk else [0.0, 0.0, 1.0]
+                for chunk in chunks]
+
+    results = [first, first, first + " (restated)", "Unrelated chunk about AT&T customers.", second]
+    assert pack_context(results, 'gpt-3.5-turbo-0125', embed=embed) == [page, "Unrelated chunk about AT&T customers."]
+
+    packed = pack_context(results, 'gpt-3.5-turbo-0125', budget=10, embed=embed)
+    assert len(packed) == 1 and count_tokens(packed[0], 'gpt-3.5-turbo-0125') <= 10
@@ -0,0 +1,88 @@
+import sys, time, threading
+sys.path.append("../")
+
+import pytest
+
+from engine.jobs import Job, JobManager
+
+# fake handlers: no pdf, no model and no cluster
+
+
+def wait(manager, job_ids, timeout=5.0):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        jobs = [manager.get(job_id) for job_id in job_ids]
+        if all(job['status'] in ('done', 'failed') for job in jobs):
+            return jobs
+        time.sleep(0.01)
+    raise TimeoutError(f"jobs not finished: {[job['status'] for job in jobs]}")
+
+
+@pytest.fixture
+def release():
+    event = threading.Event()
+    yield event
+    event.set()  # never leave a worker blocked
+
+
+def test_status_and_progress(tmp_path):
+    def upload(filepath, progress):
+        progress(pages_parsed=2)
+        progress(pages_parsed=1, chunks_embedded=5)
+        return {filepath: 'ok'}
+
+    def fail(progress):
+        raise RuntimeError('boom')
+
+    manager = JobManager(handlers={'upload': upload, 'index': fail}, jobs_file=str(tmp_path / 'jobs.json'))
+    done, failed = wait(manager, [manager.submit('upload', filepath='a.pdf').id, manager.submit('index').id])
+    assert done['status'] == 'done' and done['result'] == {'a.pdf': 'ok'}
+    assert done['progress'] == {'pages_parsed': 3, 'chunks_embedded': 5}
+    assert failed['status'] == 'failed' and failed['error'] == 'boom'
+    with pytest.raises(ValueError):
+        manager.submit('unknown')
+
+
+def test_concurrency_cap_does_not_block_other_kinds(tmp_path, release):
+    running, lock = {'index': 0, 'max_index': 0}, threading.Lock()
+
+    def index(progress):
+        with lock:
+            running['index'] += 1
+            running['max_index'] = max(running['max_index'], running['index'])
+        release.wait(5)
+        with lock:
+            running['index'] -= 1
+
+    def upload(progress):
+        return 'uploaded'
+
+    manager = JobManager(handlers={'upload': upload, 'index': index}, jobs_file=str(tmp_path / 'jobs.json'),
+                         max_workers=2, concurrency={'index': 1})
+    indexes = [manager.submit('index').id for _ in range(3)]
+    while manager.get(indexes[0])['status'] != 'running':
+        time.sleep(0.01)
+    # one index job runs, the two others wait without holding the second worker: the upload gets it
+    [upload_job] = wait(manager, [manager.submit('upload').id])
+    assert upload_job['result'] == 'uploaded'
+    assert [manager.get(job_id)['status'] for job_id in indexes] == ['running', 'queued', 'queued']
+
+    release.set()
+    assert all(job['status'] == 'done' for job in wait(manager, indexes))
+    assert running['max_index'] == 1
+
+
+def test_resume_interrupted_jobs(tmp_path):
+    jobs_file = str(tmp_path / 'jobs.json')
+    first = JobManager(handlers={'upload': lambda progress: None}, jobs_file=jobs_file)
+    with first._lock:  # as if the server had stopped while the job was running
+        job = first._jobs['1'] = Job(id='1', kind='upload', args={'filepath': 'a.pdf'}, status='running')
+        first._save()
+
+    calls = []
+    manager = JobManager(handlers={'upload': lambda filepath, progress: calls.append(filepath)}, jobs_file=jobs_file)
+    assert manager.get(job.id) is None and calls == []  # nothing runs until resume()
+    manager.resume()
+    manager.resume()
+    [resumed] = wait(manager, [job.id])
+    assert resumed['status'] == 'done' and calls == ['a.pdf']
@@ -0,0 +1,142 @@
+import sys, json, asyncio, threading
+sys.path.append("../")
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from rag.llm import LLM
+from rag.client_pool import llm_pool, TokenBucket, LLMClientPool
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    """ Minimal OpenAI-compatible /chat/completions endpoint """
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.connections.add(self.client_address)
+        self.server.requests += 1
+
+        if self.server.failures_left > 0:
+            self.server.failures_left -= 1
+            self._send(429, {'error': {'message': 'rate limited', 'type': 'rate_limit_error'}})
+            return
+
+        answer = f"echo: {body['messages'][-1]['content']}"
+        self._send(200, {'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': 0,
+                         'model': body['model'],
+                         'choices': [{'index': 0, 'finish_reason': 'stop',
+                                      'message': {'role': 'assistant', 'content': answer}}],
+                         'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2}})
+
+    def _send(self, code: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCompletionHandler)
+    server.connections, server.requests, server.failures_left = set(), 0, 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def llm(fake_server):
+    return LLM('gpt-3.5-turbo-0125', api_key='fake', api_base=f"http://127.0.0.1:{fake_server.server_port}")
+
+
+def test_chat_completion(llm):
+    assert llm.chat_completion('system', 'hello') == 'echo: hello'
+
+
+def test_connections_are_reused(llm, fake_server):
+    for i in range(3):
+        llm.chat_completion('system', f'question {i}')
+    assert fake_server.requests == 3
+    assert len(fake_server.connections) == 1
+
+
+def test_retry_on_rate_limit(llm, fake_server, monkeypatch):
+    monkeypatch.setattr(llm_pool, 'backoff', 0.01)
+    fake_server.failures_left = 2
+    retries = llm_pool.stats()['retries']
+    assert llm.chat_completion('system', 'hello') == 'echo: hello'
+    assert fake_server.requests == 3
+    assert llm_pool.stats()['retries'] == retries + 2
+
+
+def test_async_completion(llm):
+    async def ask_all():
+        return await asyncio.gather(*[llm.achat_completion('system', f'question {i}') for i in range(5)])
+    answers = asyncio.run(ask_all())
+    assert answers == [f'echo: question {i}' for i in range(5)]
+
+
+def test_token_bucket():
+    bucket = TokenBucket(requests_per_minute=600)  # 10 per second, bursts of 10
+    delays = [bucket.reserve() for _ in range(15)]
+    assert delays[:10] == [0.0] * 10
+    assert delays[10:] == pytest.approx([0.1, 0.2, 0.3, 0.4, 0.5], abs=0.01)
+
+
+def test_stream_holds_its_slot():
+    pool = LLMClientPool(max_concurrency=1)
+
+    async def fake_completion(model, stream=False, **kwargs):
+        async def tokens():
+            for token in ['a', 'b']:
+                yield token
+        return tokens()
+
+    async def run():
+        first = await pool.acall(fake_completion, model='gpt-3.5-turbo', stream=True)
+        second = asyncio.create_task(pool.acall(fake_completion, model='gpt-3.5-turbo', stream=True))
+        await asyncio.sleep(0.05)
+        assert not second.done()  # the first stream still holds the only slot
+        assert [token async for token in first] == ['a', 'b']
+        second = await asyncio.wait_for(second, 1)
+        await second.aclose()  # closed before the end: released too
+        third = await asyncio.wait_for(pool.acall(fake_completion, model='gpt-3.5-turbo', stream=True), 1)
+        await third.aclose()
+
+    asyncio.run(run())
+
+
+
+def test_async_session_closed_with_its_loop():
+    pool = LLMClientPool()
+
+    async def bind():
+        await pool._bind_loop()
+        return pool._asession
+
+    first = asyncio.run(bind())
+    second = asyncio.run(bind())  # a new loop: the session of the previous one is closed
+    assert first.is_closed and not second.is_closed
+    asyncio.run(pool.aclose())
+    assert second.is_closed
+
+
+def test_sync_stream_holds_its_slot():
+    pool = LLMClientPool(max_concurrency=1)
+
+    def fake_completion(model, stream=False, **kwargs):
+        return iter(['a', 'b'])
+
+    first = pool.call(fake_completion, model='gpt-3.5-turbo', stream=True)
+    assert not pool._semaphore('openai').acquire(blocking=False)  # the only slot is taken until the end
+    assert list(first) == ['a', 'b']
+    second = pool.call(fake_completion, model='gpt-3.5-turbo', stream=True)
+    second.close()  # closed before the end: released too
+    assert pool._semaphore('openai').acquire(blocking=False)
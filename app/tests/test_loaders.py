@@ -0,0 +1,35 @@
+import sys
+sys.path.append("../")
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+from engine.loaders.file import pdf_extractor
+
+# a small pdf with one ruled table, generated on the fly
+
+
+def make_table_pdf(path, cells, x0=72, y0=72, width=120, height=24):
+    doc = fitz.open()
+    page = doc.new_page()
+    for i, row in enumerate(cells):
+        for j, cell in enumerate(row):
+            rect = fitz.Rect(x0 + j * width, y0 + i * height, x0 + (j + 1) * width, y0 + (i + 1) * height)
+            page.draw_rect(rect, color=(0, 0, 0), width=1)
+            page.insert_text((rect.x0 + 4, rect.y1 - 8), cell, fontsize=10)
+    doc.save(path)
+    doc.close()
+
+
+def test_extract_tables_header_not_in_rows(tmp_path):
+    cells = [['Segment', 'Revenue', 'Income'],
+             ['North America', '315880', '-2847'],
+             ['AWS', '80096', '22841']]
+    path = str(tmp_path / 'table.pdf')
+    make_table_pdf(path, cells)
+
+    [table] = pdf_extractor('PyMuPDF', path).extract_tables()['table.pdf']
+    assert table['page'] == 0
+    assert table['header'] == cells[0]
+    assert table['rows'] == cells[1:]
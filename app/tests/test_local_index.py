@@ -0,0 +1,75 @@
+import sys
+sys.path.append("../")
+
+import numpy as np
+import pytest
+
+from engine.local_index import LocalWCS, LocalIndexer
+
+# no cluster and no model: the query vectors are given
+
+
+@pytest.fixture
+def documents():
+    rng = np.random.default_rng(0)
+    contents = ["AT&T has 70 million postpaid phone customers", "Amazon reported a net loss in 2022",
+                "Revenue grew by 10% thanks to the cloud business", "The net loss per share was 0.27 dollars"]
+    return [{'content': content, 'filename': f"doc{i % 2}.pdf", 'page': i + 1, 'ticker': 'AMZN' if i % 2 else 'T',
+             'chunk_id': f"00000000-0000-0000-0000-00000000000{i}",
+             'content_embedding': rng.normal(size=16).astype(np.float32)} for i, content in enumerate(contents)]
+
+
+@pytest.fixture
+def client(tmp_path, documents):
+    client = LocalWCS(path=str(tmp_path), model_name_or_path=None)
+    LocalIndexer(client).batch_index_data(documents, 'Finrag', uuid_field='chunk_id')
+    return client
+
+
+def test_vector_search(client, documents):
+    results = client.vector_search('', 'Finrag', limit=2, query_vector=documents[2]['content_embedding'])
+    assert results[0]['content'] == documents[2]['content']
+    assert results[0]['distance'] == pytest.approx(0, abs=1e-5)
+
+
+def test_keyword_search(client):
+    results = client.keyword_search('net loss', 'Finrag', limit=5)
+    assert {r['content'] for r in results} == {"Amazon reported a net loss in 2022",
+                                               "The net loss per share was 0.27 dollars"}
+
+
+def test_hybrid_search_with_filter(client, documents):
+    results = client.hybrid_search('net loss', 'Finrag', limit=5, filter={'filename': 'doc1.pdf'},
+                                   query_vector=documents[1]['content_embedding'])
+    assert results[0]['content'] == documents[1]['content']
+    assert all(r['filename'] == 'doc1.pdf' for r in results)
+
+
+def test_metadata_filter(client, documents):
+    results = client.keyword_search('net loss', 'Finrag', limit=5, filter={'ticker': 'AMZN', 'page': 4})
+    assert [r['content'] for r in results] == ["The net loss per share was 0.27 dollars"]
+
+
+def test_upsert_and_persistence(tmp_path, client, documents):
+    LocalIndexer(client).batch_index_data(documents, 'Finrag', uuid_field='chunk_id')  # same ids: replaced
+    assert client.get_doc_count('Finrag') == len(documents)
+
+    reopened = LocalWCS(path=str(tmp_path), model_name_or_path=None)
+    assert reopened.get_doc_count('Finrag') == len(documents)
+    results = reopened.vector_search('', 'Finrag', limit=1, query_vector=documents[0]['content_embedding'])
+    assert results[0]['content'] == documents[0]['content']
+
+
+
+@pytest.mark.parametrize('ann_threshold', [1, 1_000])  # with and without the HNSW index (if hnswlib is installed)
+def test_duplicate_uuids_in_batch(tmp_path, documents, ann_threshold):
+    client = LocalWCS(path=str(tmp_path), model_name_or_path=None, ann_threshold=ann_threshold)
+    LocalIndexer(client).batch_index_data(documents, 'Finrag', uuid_field='chunk_id')
+    client.vector_search('', 'Finrag', limit=1, query_vector=documents[0]['content_embedding'])  # builds the index
+    updated = dict(documents[0], content="AT&T has 71 million postpaid phone customers")
+    LocalIndexer(client).batch_index_data([documents[0], updated, documents[1]], 'Finrag', uuid_field='chunk_id')
+    assert client.get_doc_count('Finrag') == len(documents)
+
+    reopened = LocalWCS(path=str(tmp_path), model_name_or_path=None, ann_threshold=ann_threshold)
+    results = reopened.vector_search('', 'Finrag', limit=1, query_vector=documents[0]['content_embedding'])
+    assert results[0]['content'] == updated['content']
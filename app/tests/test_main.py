@@ -1,10 +1,11 @@
-import os, sys
+import os, sys, json, asyncio
 sys.path.append("../")
 from main import app
 
+import httpx
 from fastapi.testclient import TestClient
 
-from settings import datadir
+from settings import datadir, state_files
 
 client = TestClient(app)
 
@@ -15,11 +16,12 @@ def test_read_root():
     
 def test_list_files():
     response = client.get("/list_files/")
-    files = os.listdir(datadir)
+    files = [f for f in os.listdir(datadir) if not f.startswith(state_files)]
     assert response.status_code == 200
     assert len(response.json()['files']) == len(files)
     for f in response.json()['files']:
         assert f in files
+    assert not any(f.startswith(('jobs.json', 'ledger.sqlite', 'staging')) for f in response.json()['files'])
         
 def test_vector_search():
     question_data = {"question": "Does ATT have postpaid phone customers?"}
@@ -34,3 +36,178 @@ def test_ragit():
     response = client.post("/ragit/", json=question_data)
     assert response.status_code == 200
     assert 'yes' in response.json()['answer'].lower()
+
+
+def test_health():
+    assert client.get("/health/live").status_code == 200
+    client.post("/ask/", json={"question": "what is the net loss"})  # creates the vector store if needed
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json()["vectorstore"] == "ready"
+
+
+def test_list_models():
+    response = client.get("/models/")
+    assert response.status_code == 200
+    # the vector store loads the embedding model when the app is imported
+    assert all(size > 0 for size in response.json()['models'].values())
+
+
+def test_query_vector_cache():
+    question_data = {"question": "Does ATT have postpaid phone customers?"}
+    client.post("/ask/", json=question_data)
+    hits = client.get("/stats/").json()['query_vectors']['hits']
+    client.post("/ask/", json={"question": "  does ATT have postpaid phone customers? "})
+    assert client.get("/stats/").json()['query_vectors']['hits'] == hits + 1
+
+
+def test_connections_are_reused():
+    client.post("/ask/", json={"question": "what is the net loss"})
+    stats = client.get("/stats/").json()['weaviate_connections']
+    assert stats['open'] <= stats['size']
+    assert stats['reused'] > 0
+
+
+def test_concurrent_searches():
+    questions = ["Does ATT have postpaid phone customers?", "what is Amazon loss", "what is the net loss"]
+
+    async def ask_all():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as aclient:
+            return await asyncio.gather(*[aclient.post("/ask/", json={"question": q}) for q in questions])
+
+    responses = asyncio.run(ask_all())
+    assert all(r.status_code == 200 for r in responses)
+    assert any(['postpaid' in a.lower() for a in responses[0].json()['answer']])
+
+
+def test_rerank():
+    question = "what is the net loss"
+    assert len(client.post("/ask/", json={"question": question, "rerank": False}).json()["answer"]) == 3
+    
+    reranked = client.post("/ask/", json={"question": question, "rerank": True}).json()["answer"]
+    assert len(reranked) == 3
+    hits = client.get("/stats/").json()['rerank']['cache_hits']
+    # the (question, chunk) scores are cached
+    assert client.post("/ask/", json={"question": question, "rerank": True}).json()["answer"] == reranked
+    assert client.get("/stats/").json()['rerank']['cache_hits'] > hits
+
+
+def test_rerank_budget_excludes_model_load(monkeypatch):
+    import time
+    from engine import rerank
+
+    class SlowToLoad:
+        def predict(self, pairs, **kwargs):
+            return [len(chunk) for _, chunk in pairs]  # the longest chunk first
+
+    def get_cross_encoder(model_name, device):
+        time.sleep(0.2)  # longer than the budget
+        return SlowToLoad()
+
+    monkeypatch.setattr(rerank, 'get_cross_encoder', get_cross_encoder)
+    reranker = rerank.Reranker(model_name='slow-to-load', budget=0.1)
+    assert reranker.rerank("a question never asked", ["a", "abc", "ab"], top_k=3) == ["abc", "ab", "a"]
+    assert reranker.stats()['over_budget'] == 0
+
+
+def test_fusion():
+    question = "what is the net loss"
+    for method in ['rrf', 'relative']:
+        answer = client.post("/ask/", json={"question": question, "rerank": False, "fusion": method}).json()["answer"]
+        assert len(answer) == 3 and len(set(answer)) == 3  # chunks found by both searches appear once
+    fusion = client.get("/stats/").json()['fusion']
+    assert fusion['keyword']['searches'] >= 2 and fusion['vector']['searches'] >= 2
+    assert client.post("/ask/", json={"question": question, "fusion": "max"}).status_code == 422
+
+
+def test_ask_batch():
+    questions = ["Does ATT have postpaid phone customers?", "what is Amazon loss", "what is the net loss"]
+    response = client.post("/ask_batch/", json={"questions": questions})
+    assert response.status_code == 200
+    answers = response.json()["answers"]
+    assert len(answers) == len(questions)
+    for question, answer in zip(questions, answers):  # same order as the questions
+        assert answer == client.post("/ask/", json={"question": question}).json()["answer"]
+
+
+def test_ragit_batch():
+    questions = ["Does ATT have postpaid phone customers?", "what is Amazon loss"]
+    response = client.post("/ragit_batch/", json={"questions": questions})
+    assert response.status_code == 200
+    answers = response.json()["answers"]
+    assert [answer["question"] for answer in answers] == questions
+    assert all(answer["answer"] for answer in answers)
+
+
+def test_ragit_stream():
+    question_data = {"question": "Does ATT have postpaid phone customers?"}
+    events = []
+    with client.stream("POST", "/ragit_stream/", json=question_data) as response:
+        assert response.status_code == 200
+        for line in response.iter_lines():
+            if line.startswith("event: "):
+                events.append([line[len("event: "):]])
+            elif line.startswith("data: "):
+                events[-1].append(json.loads(line[len("data: "):]))
+    
+    assert events[0][0] == 'sources' and len(events[0][1]) > 0
+    assert events[-1][0] == 'done'
+    answer = ''.join(data for event, data in events if event == 'token')
+    assert 'yes' in answer.lower()
+
+
+def test_answer_cache():
+    question_data = {"question": "Does ATT have postpaid phone customers?"}
+    first = client.post("/ragit/", json=question_data).json()['answer']
+    hits = client.get("/stats/").json()['answers']['hits']
+    second = client.post("/ragit/", json={"question": "Does ATT have postpaid phone customers ?"}).json()['answer']
+    assert second == first
+    assert client.get("/stats/").json()['answers']['hits'] == hits + 1
+
+
+def test_index_ledger():
+    stats = client.get("/stats/").json()['index_ledger']
+    assert set(stats) == {'files', 'chunks'}
+    assert set(stats['chunks']) <= {'staged', 'indexed', 'failed'}
+
+
+def test_search_filters():
+    question = {"question": "Does ATT have postpaid phone customers?", "rerank": False}
+    assert len(client.post("/ask/", json=question).json()["answer"]) > 0
+    # pushed down to the vector store: no chunk of this company, no results
+    response = client.post("/ask/", json={**question, "filters": {"ticker": "NOPE", "fiscal_period": "Q2 2023"}})
+    assert response.status_code == 200
+    assert response.json()["answer"] == []
+
+
+def test_weaviate_search_filter():
+    # no cluster needed: only the filter object is built
+    from engine.vectorstore import VectorStore
+    store = VectorStore.__new__(VectorStore)
+    store.backend = 'weaviate'
+    assert store.search_filter({'ticker': None, 'filename': ''}) is None
+    single = store.search_filter({'ticker': 'amzn'})
+    assert (single.target, single.operator, single.value) == ('ticker', 'Equal', 'AMZN')
+    both = store.search_filter({'ticker': 'amzn', 'fiscal_period': 'fy 2022', 'page': 3})
+    assert both.operator == 'And'
+    assert [(f.target, f.value) for f in both.filters] == [('ticker', 'AMZN'), ('fiscal_period', 'FY2022'), ('page', 3)]
+
+
+def test_parse_filename():
+    from engine.metadata import parse_filename, file_metadata
+    assert parse_filename("AMZN_10-K_2022.pdf") == {'ticker': 'AMZN', 'fiscal_period': 'FY2022'}
+    assert parse_filename("AT&T-2023-Q2.pdf") == {'ticker': 'ATT', 'fiscal_period': '2023-Q2'}
+    assert parse_filename("att-2023-Q2.pdf") == {'ticker': None, 'fiscal_period': '2023-Q2'}
+    assert parse_filename("Annual report.pdf") == {'ticker': None, 'fiscal_period': None}
+    # words that are not written as tickers are not taken as tickers
+    assert parse_filename("test.pdf")['ticker'] is None
+    assert parse_filename("Apple_10K_2022.pdf") == {'ticker': None, 'fiscal_period': 'FY2022'}
+    assert parse_filename("Tesla 2023 annual report.pdf") == {'ticker': None, 'fiscal_period': 'FY2023'}
+    # the upload form wins over the file name
+    assert file_metadata("att-2023-Q2.pdf", ticker="t", fiscal_period="q3 2023") == {'ticker': 'T', 'fiscal_period': '2023-Q3'}
+
+
+def test_unknown_job():
+    response = client.get("/jobs/does-not-exist")
+    assert response.status_code == 404